@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+"""
+benchmark-parsers.py
+
+Usage:
+    benchmark-parsers.py [options] [<benchmark>...]
+
+Options:
+    --repeat=<N>            timed runs per benchmark (best run counts) [default: 5]
+    --baseline=<FILE>       baseline file [default: benchmark-baseline.json]
+    --save-baseline         store the results as new baseline
+    --tolerance=<PCT>       allowed slowdown compared to the baseline [default: 20]
+    --list                  show available benchmarks
+"""
+
+import asyncio
+import atexit
+from dataclasses import dataclass
+import importlib
+import json
+from pathlib import Path
+import random
+import re
+import sys
+import tempfile
+import time
+import tracemalloc
+
+try:
+    from docopt import docopt
+except ImportError:
+    sys.stderr.write('please install python3-docopt\n')
+    sys.exit(1)
+
+_bz = importlib.import_module('bugzilla-utils')
+_bodhi = importlib.import_module('create-bodhi-update')
+_git = importlib.import_module('git-utils')
+_koji = importlib.import_module('koji-utils')
+_pkg_list = importlib.import_module('pkg-list')
+_shell_utils = importlib.import_module('shell-utils')
+_sources = importlib.import_module('sources-utils')
+_spec = importlib.import_module('spec-utils')
+_trigger = importlib.import_module('trigger-builds')
+
+print_status_output = _shell_utils.print_status_output
+
+THIS_DIR = Path(__file__).parent.resolve()
+
+PKG_NAMES = ['python-acme', 'certbot'] + [f'python-certbot-dns-plugin{i}' for i in range(40)]
+DISTS = ('fc35', 'fc34', 'fc33', 'el8', 'el7')
+
+
+# --- synthetic input -----------------------------------------------------------
+def generate_koji_builds(n_builds, rng):
+    builds = []
+    for build_id in range(n_builds, 0, -1):
+        pkg_name = rng.choice(PKG_NAMES + [f'unrelated-pkg{i}' for i in range(200)])
+        version = f'1.{rng.randrange(30)}.{rng.randrange(5)}'
+        release = f'{rng.randrange(1, 4)}.{rng.choice(DISTS)}'
+        builds.append({
+            'build_id': build_id,
+            'name': pkg_name,
+            'release': release,
+            'nvr': f'{pkg_name}-{version}-{release}',
+        })
+    return builds
+
+
+def generate_bug_pages(n_bugs, rng, *, page_size=100):
+    bugs = []
+    for bug_id in range(1, n_bugs + 1):
+        pkg_name = rng.choice(PKG_NAMES)
+        bugs.append({
+            'id': 1900000 + bug_id,
+            'component': [pkg_name],
+            'summary': f'{pkg_name}-1.{rng.randrange(30)}.0 is available',
+            'status': rng.choice(('NEW', 'ASSIGNED')),
+        })
+    pages = []
+    for offset in range(0, n_bugs, page_size):
+        page = {'bugs': bugs[offset:offset+page_size], 'total_matches': n_bugs}
+        pages.append(json.dumps(page).encode('utf8'))
+    return pages
+
+
+def generate_build_log(n_bytes, rng, *, final_line):
+    lines = []
+    size = 0
+    while size < n_bytes:
+        line = f'DEBUG util.py:{rng.randrange(1000)}:  ' + 'x' * rng.randrange(20, 160) + '\n'
+        lines.append(line.encode('ascii'))
+        size += len(line)
+    lines.append(final_line)
+    return lines
+
+
+def generate_spectool_output(n_sources):
+    lines = []
+    for idx in range(n_sources):
+        if idx % 3 == 2:
+            lines.append(f'Source{idx}: local-file-{idx}.conf')
+        else:
+            lines.append(f'Source{idx}: https://files.pythonhosted.org/packages/source/c/certbot/certbot-{idx}.tar.gz')
+        lines.append(f'Patch{idx}: fix-{idx}.patch')
+    return '\n'.join(lines)
+
+
+def generate_spec(n_macros, rng):
+    lines = ['%global pypi_name certbot', '%bcond_without docs']
+    for idx in range(n_macros):
+        lines.append(f'%global macro{idx} {rng.randrange(1000)}')
+        lines.append('%if %{with docs}')
+        lines.append(f'%global doc_macro{idx} %{{macro{idx}}}')
+        lines.append('%endif')
+    lines += [
+        'Name:    python-%{pypi_name}',
+        f'Version: 1.%{{macro{n_macros - 1}}}.0',
+        'Release: 1%{?dist}',
+        '%description',
+    ]
+    return '\n'.join(lines)
+
+
+def generate_git_status(n_entries):
+    header = [
+        '# branch.oid 0123456789abcdef0123456789abcdef01234567',
+        '# branch.head rawhide',
+        '# branch.upstream origin/rawhide',
+        '# branch.ab +1 -0',
+    ]
+    entries = []
+    for idx in range(n_entries):
+        if idx % 4 == 3:
+            entries.append(f'? untracked-{idx}.tar.gz')
+        else:
+            entries.append(f'1 .M N... 100644 100644 100644 {"a" * 40} {"b" * 40} file-{idx}.patch')
+    return '\0'.join(header + entries).encode('utf8') + b'\0'
+
+
+# --- benchmarks ----------------------------------------------------------------
+@dataclass
+class Workload:
+    run    : object   # callable without arguments
+    n_items: int
+    n_bytes: int = 0
+
+
+def bench_koji_index(rng):
+    builds = generate_koji_builds(50_000, rng)
+    return Workload(lambda: _koji.index_builds(builds), len(builds))
+
+
+def bench_version_from_build(rng):
+    nvrs = [build['nvr'] for build in generate_koji_builds(50_000, rng)]
+    def run():
+        for nvr in nvrs:
+            _bodhi.version_from_build(nvr)
+    return Workload(run, len(nvrs), sum(map(len, nvrs)))
+
+
+def bench_bugzilla_pages(rng):
+    pages = generate_bug_pages(10_000, rng)
+    def run():
+        for page in pages:
+            for bug in _bz._parse_bug_page(json.loads(page)):
+                pass
+    return Workload(run, 10_000, sum(map(len, pages)))
+
+
+class _LogProcess:
+    """Just enough of an asyncio Process to feed a build log to BuildProcess."""
+    def __init__(self, log_lines):
+        self.stdout = asyncio.StreamReader(limit=2**20)
+        self.stdout.feed_data(b''.join(log_lines))
+        self.stdout.feed_eof()
+        self.stderr = asyncio.StreamReader()
+        self.stderr.feed_eof()
+        self.returncode = 0
+
+    async def wait(self):
+        return self.returncode
+
+
+def _bench_build_log(log_lines, regex, *, multiline_regex):
+    log_dir = tempfile.TemporaryDirectory()
+    atexit.register(log_dir.cleanup)
+    async def extract():
+        build = _trigger.BuildProcess(pkg_name='certbot', proc=_LogProcess(log_lines), type_='koji', log_dir=log_dir.name)
+        await _trigger._extract_urls_from_build_output(build, regex, multiline_regex=multiline_regex)
+        assert build.url
+    n_bytes = sum(map(len, log_lines))
+    return Workload(lambda: asyncio.run(extract()), len(log_lines), n_bytes)
+
+
+def bench_koji_build_log(rng):
+    final_line = b'Task info: https://koji.fedoraproject.org/koji/taskinfo?taskID=12345\n'
+    log_lines = generate_build_log(4 * 2**20, rng, final_line=final_line)
+    regex = re.compile(b'Task info: (https://.+?\=(\d+))\n')
+    return _bench_build_log(log_lines, regex, multiline_regex=False)
+
+
+def bench_copr_build_log(rng):
+    final_line = b'Build was added to certbot:\n  https://copr.fedorainfracloud.org/coprs/build/4711\n'
+    log_lines = generate_build_log(256 * 2**10, rng, final_line=final_line)
+    regex = re.compile(b'Build was added to certbot:\s*(https://.+?/build/(\d+))\s*\n')
+    return _bench_build_log(log_lines, regex, multiline_regex=True)
+
+
+def bench_spectool_sources(rng):
+    stdout_str = generate_spectool_output(5_000)
+    def run():
+        tuple(_sources.parse_spectool_sources(stdout_str))
+        _sources.parse_spectool_source_files(stdout_str)
+    return Workload(run, 5_000, len(stdout_str))
+
+
+def bench_package_list(rng):
+    tmp_file = tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False)
+    with tmp_file:
+        for idx in range(20_000):
+            tmp_file.write(f'python-certbot-dns-plugin{idx}\n' if idx % 10 else '# comment\n')
+    atexit.register(Path(tmp_file.name).unlink)
+    return Workload(lambda: _pkg_list.parse_package_list(tmp_file.name), 20_000, Path(tmp_file.name).stat().st_size)
+
+
+def bench_spec_version(rng):
+    spec_str = generate_spec(500, rng)
+    return Workload(lambda: _spec.parse_spec_version(spec_str), 500, len(spec_str))
+
+
+def bench_git_status(rng):
+    status_bytes = generate_git_status(20_000)
+    return Workload(lambda: _git.parse_status_output(status_bytes), 20_000, len(status_bytes))
+
+
+BENCHMARKS = {
+    'koji-index'        : bench_koji_index,
+    'version-from-build': bench_version_from_build,
+    'bugzilla-pages'    : bench_bugzilla_pages,
+    'koji-build-log'    : bench_koji_build_log,
+    'copr-build-log'    : bench_copr_build_log,
+    'spectool-sources'  : bench_spectool_sources,
+    'package-list'      : bench_package_list,
+    'spec-version'      : bench_spec_version,
+    'git-status'        : bench_git_status,
+}
+
+
+def run_benchmark(name, *, repeat):
+    # same input for every run so results are comparable
+    workload = BENCHMARKS[name](random.Random(name))
+    workload.run()  # warm up (regex compilation, imports)
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        workload.run()
+        durations.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    workload.run()
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    best = min(durations)
+    return {
+        'seconds': best,
+        'items_per_second': workload.n_items / best,
+        'mb_per_second': (workload.n_bytes / 2**20) / best,
+        'peak_memory_mb': peak_memory / 2**20,
+    }
+
+
+def main():
+    arguments = docopt(__doc__)
+    if arguments['--list']:
+        print('\n'.join(BENCHMARKS))
+        return
+    names = arguments['<benchmark>'] or list(BENCHMARKS)
+    unknown_names = set(names).difference(BENCHMARKS)
+    if unknown_names:
+        print_status_output(f'unknown benchmark {", ".join(sorted(unknown_names))}', is_error=True)
+        sys.exit(1)
+    repeat = int(arguments['--repeat'])
+    tolerance = int(arguments['--tolerance']) / 100
+    baseline_path = THIS_DIR / arguments['--baseline']
+    baseline = json.loads(baseline_path.read_text()) if baseline_path.exists() else {}
+
+    results = {}
+    has_regression = False
+    for name in names:
+        result = run_benchmark(name, repeat=repeat)
+        results[name] = result
+        msg = (
+            f'{result["seconds"]*1000:9.2f} ms  {result["items_per_second"]:12,.0f} items/s  '
+            f'{result["mb_per_second"]:8.1f} MB/s  {result["peak_memory_mb"]:8.1f} MB peak'
+        )
+        is_regression = False
+        if name in baseline:
+            ratio = result['seconds'] / baseline[name]['seconds']
+            msg += f'  ({ratio:.2f}x baseline)'
+            is_regression = (ratio > 1 + tolerance)
+        has_regression = has_regression or is_regression
+        print_status_output(f'{name:<20}', is_error=is_regression, msg=msg)
+
+    if arguments['--save-baseline']:
+        baseline.update(results)
+        baseline_path.write_text(json.dumps(baseline, indent=2, sort_keys=True))
+    if has_regression:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,48 +1,214 @@
 
-import csv
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timedelta, timezone
+import http.client
 import importlib
-from io import StringIO
+import json
+import queue
+import threading
+import time
+from urllib.parse import parse_qsl, urlencode, urlsplit
 
 
-_shell = importlib.import_module('shell-utils')
+_cache_utils = importlib.import_module('cache-utils')
+_trace = importlib.import_module('trace-utils')
 
-def retrieve_release_notification_bugs(pkg_names, *, verbose_dry_run=False):
-    bz_stdout = query_bugzilla(pkg_names, verbose_dry_run=verbose_dry_run)
-    return parse_bz_output(bz_stdout, pkg_names)
+BUGZILLA_URL = 'https://bugzilla.redhat.com'
+RELEASE_MONITORING_EMAIL = 'upstream-release-monitoring@fedoraproject.org'
+OPEN_STATUSES = ('NEW', 'ASSIGNED')
+DEFAULT_CACHE_TTL = 60 * 60
+# older cache entries are fetched again completely
+MAX_REVALIDATION_AGE = 7 * 24 * 60 * 60
 
-def query_bugzilla(pkg_names, *, verbose_dry_run=False):
+_query_cache = _cache_utils.JSONFileCache('bugzilla-queries.json')
+
+
+class BugzillaError(Exception):
+    pass
+
+
+class _ConnectionPool:
+    """Keep-alive HTTP(S) connections to a single host, shared by threads."""
+    def __init__(self, base_url, *, max_connections):
+        url_parts = urlsplit(base_url)
+        self.host = url_parts.netloc
+        self.path_prefix = url_parts.path.rstrip('/')
+        if url_parts.scheme == 'https':
+            self._connection_class = http.client.HTTPSConnection
+        else:
+            self._connection_class = http.client.HTTPConnection
+        self._idle = queue.LifoQueue()
+        # limits the number of connections in use (and therefore open)
+        self._slots = threading.BoundedSemaphore(max_connections)
+        self.max_connections = max_connections
+
+    def request_json(self, path, params, *, timeout=60):
+        with self._slots:
+            return self._request_json(path, params, timeout=timeout)
+
+    def _request_json(self, path, params, *, timeout):
+        url = f'{self.path_prefix}{path}?{urlencode(params)}'
+        headers = {'Accept': 'application/json'}
+        # a kept-alive connection might have been closed by the server in the
+        # meantime so retry once with a fresh connection
+        for attempt in range(2):
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                conn = self._connection_class(self.host, timeout=timeout)
+            try:
+                with _trace.traced(('bugzilla', 'GET', url)) as trace_info:
+                    conn.request('GET', url, headers=headers)
+                    response = conn.getresponse()
+                    body = response.read()
+                    trace_info['returncode'] = response.status
+                    trace_info['output_bytes'] = len(body)
+            except (http.client.HTTPException, ConnectionError):
+                conn.close()
+                if attempt:
+                    raise
+                continue
+            self._idle.put(conn)
+            if response.status != 200:
+                raise BugzillaError(f'HTTP {response.status} for {url}: {body[:200]!r}')
+            return json.loads(body)
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+def _parse_bug_page(page):
+    for bug in page['bugs']:
+        component = bug['component']
+        # Red Hat Bugzilla returns a list of components
+        if isinstance(component, list):
+            component = component[0]
+        yield (component, bug['summary'], str(bug['id']), bug['status'])
+
+
+class BugzillaClient:
+    def __init__(self, base_url=BUGZILLA_URL, *, max_connections=4, page_size=100, components_per_query=20):
+        self._pool = _ConnectionPool(base_url, max_connections=max_connections)
+        self.page_size = page_size
+        self.components_per_query = components_per_query
+
+    def close(self):
+        self._pool.close()
+
+    def _fetch_page(self, params, offset):
+        page_params = [*params, ('limit', self.page_size), ('offset', offset)]
+        return self._pool.request_json('/rest/bug', page_params)
+
+    def iter_bugs(self, components, *, statuses=OPEN_STATUSES, reporter=RELEASE_MONITORING_EMAIL, changed_since=None):
+        """Yield (component, summary, bug id, status) for all matching bugs.
+
+        Component lists are split into several queries which are fetched
+        concurrently (including further pages). Bugs are yielded as soon as
+        their page was received."""
+        base_params = [
+            ('include_fields', 'id,component,summary,status'),
+            ('reporter', reporter),
+            *(('status', status) for status in (statuses or ())),
+        ]
+        if changed_since:
+            base_params.append(('last_change_time', changed_since.strftime('%Y-%m-%dT%H:%M:%SZ')))
+        components = list(components)
+        chunk_size = self.components_per_query
+        chunks = [components[idx:idx+chunk_size] for idx in range(0, len(components), chunk_size)]
+
+        with ThreadPoolExecutor(max_workers=self._pool.max_connections) as executor:
+            pending = {}
+            for chunk in chunks:
+                params = [*base_params, *(('component', c) for c in chunk)]
+                future = executor.submit(self._fetch_page, params, 0)
+                pending[future] = (params, 0)
+
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    params, offset = pending.pop(future)
+                    page = future.result()
+                    if offset == 0 and ('total_matches' in page):
+                        # total known: request all remaining pages at once
+                        next_offsets = range(self.page_size, page['total_matches'], self.page_size)
+                    elif ('total_matches' not in page) and (len(page['bugs']) == self.page_size):
+                        next_offsets = (offset + self.page_size, )
+                    else:
+                        next_offsets = ()
+                    for next_offset in next_offsets:
+                        next_future = executor.submit(self._fetch_page, params, next_offset)
+                        pending[next_future] = (params, next_offset)
+                    yield from _parse_bug_page(page)
+
+
+def retrieve_release_notification_bugs(pkg_names, *, verbose_dry_run=False, refresh=False, cache_ttl=DEFAULT_CACHE_TTL, client=None):
+    query_url = build_query_url(pkg_names)
+    if verbose_dry_run:
+        print(query_url)
+    bugs = _cached_query(query_url, pkg_names, refresh=refresh, cache_ttl=cache_ttl, client=client)
+    pkg_data = {}
+    for bug_id in sorted(bugs, key=int):
+        pkg_name, bug_summary = bugs[bug_id]
+        if pkg_name not in pkg_names:
+            continue
+        pkg_data[pkg_name] = (bug_summary, bug_id)
+    return pkg_data
+
+def build_query_url(pkg_names):
     qs_str = '&'.join([
-        'bug_status=NEW',
-        'bug_status=ASSIGNED',
+        *(f'bug_status={status}' for status in OPEN_STATUSES),
         'query_format=advanced',
         'emailreporter1=1',
         'emailtype1=substring',
         'email1=upstream-release-monitoring%40fedoraproject.org',
         *(map(lambda p: f'component={p}', pkg_names))
     ])
-    query_url = f'https://bugzilla.redhat.com/buglist.cgi?{qs_str}'
-    if verbose_dry_run:
-        print(query_url)
-    bugzilla_cmd = (
-        '/usr/bin/bugzilla',
-        'query',
-        f'--from-url={query_url}',
-        '--outputformat', '%{component}|%{summary}|%{id}'
-    )
-    bugzilla_proc = _shell.run_cmd(bugzilla_cmd, wait=True)
-    bz_stdout = bugzilla_proc.stdout.read().decode('utf8')
-    assert bugzilla_proc.returncode == 0
-    return bz_stdout
-
-def parse_bz_output(stdout_str, pkg_names):
-    bz_fp = StringIO(stdout_str)
+    return f'{BUGZILLA_URL}/buglist.cgi?{qs_str}'
 
-    pkg_data = {}
-    for line in csv.reader(bz_fp, delimiter='|', quoting=csv.QUOTE_MINIMAL):
-        pkg_name, bug_summary, bug_id = line
-        if pkg_name not in pkg_names:
-            continue
-        pkg_data[pkg_name] = (bug_summary, bug_id)
+def normalize_query_url(query_url):
+    url_parts = urlsplit(query_url)
+    query_items = sorted(parse_qsl(url_parts.query, keep_blank_values=True))
+    return url_parts._replace(query=urlencode(query_items)).geturl()
 
-    return pkg_data
+def _cached_query(query_url, pkg_names, *, refresh, cache_ttl, client):
+    cache_key = normalize_query_url(query_url)
+    cache_entry = _query_cache.get(cache_key)
+    now = time.time()
+    if cache_entry and not refresh:
+        age = now - cache_entry['fetched_at']
+        if age < cache_ttl:
+            return cache_entry['bugs']
+
+    owns_client = (client is None)
+    if owns_client:
+        client = BugzillaClient()
+    try:
+        if cache_entry and not refresh and (age < MAX_REVALIDATION_AGE):
+            bugs = _revalidate(client, pkg_names, cache_entry)
+        else:
+            bugs = {}
+            for pkg_name, bug_summary, bug_id, status in client.iter_bugs(pkg_names):
+                bugs[bug_id] = (pkg_name, bug_summary)
+    finally:
+        if owns_client:
+            client.close()
+    _query_cache.set(cache_key, {'fetched_at': now, 'bugs': bugs})
+    return bugs
 
+def _revalidate(client, pkg_names, cache_entry):
+    """Update cached bugs with all bugs which changed since the last query."""
+    fetched_at = datetime.fromtimestamp(cache_entry['fetched_at'], tz=timezone.utc)
+    # some overlap so no change is lost due to clock skew
+    changed_since = fetched_at - timedelta(minutes=5)
+    bugs = dict(cache_entry['bugs'])
+    # no status filter: bugs which were closed must be removed from the cache
+    for pkg_name, bug_summary, bug_id, status in client.iter_bugs(pkg_names, statuses=None, changed_since=changed_since):
+        if status in OPEN_STATUSES:
+            bugs[bug_id] = (pkg_name, bug_summary)
+        else:
+            bugs.pop(bug_id, None)
+    return bugs
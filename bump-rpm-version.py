@@ -3,23 +3,33 @@
 bump-rpm-version.py
 
 Usage:
-    bump-rpm-version.py [--no-upload] <package> <version>
-    bump-rpm-version.py [--no-upload] <package> <bug-summary> <bug-id>
+    bump-rpm-version.py [--no-upload] [--full-prep] <package> <version>
+    bump-rpm-version.py [--no-upload] [--full-prep] <package> <bug-summary> <bug-id>
+
+Options:
+    --full-prep     verify signatures by running "fedpkg prep"
 """
 
 import importlib
 from pathlib import Path
 import re
+import threading
 
 from docopt import docopt
 
 _git = importlib.import_module('git-utils')
+_gpg = importlib.import_module('gpg-utils')
 _shell_utils = importlib.import_module('shell-utils')
 print_status_output = _shell_utils.print_status_output
 run_cmd = _shell_utils.run_cmd
+_sources = importlib.import_module('sources-utils')
 _spec = importlib.import_module('spec-utils')
 
 
+class BumpError(Exception):
+    pass
+
+
 def _bump_spec(pkg_path, pkg_name, new_version, message):
     bumpspec_cmd = [
         '/usr/bin/rpmdev-bumpspec',
@@ -28,94 +38,145 @@ def _bump_spec(pkg_path, pkg_name, new_version, message):
         '--legacy-datestamp',
         f'{pkg_name}.spec'
     ]
-    bumpspec_proc = run_cmd(bumpspec_cmd, working_directory=pkg_path, wait=True, exit_on_error=False)
+    bumpspec_proc = run_cmd(bumpspec_cmd, working_directory=pkg_path, exit_on_error=False)
+    # commands outside of git-utils change the work tree behind its back
+    _git.invalidate_repo_state(pkg_path)
     if bumpspec_proc.returncode != 0:
-        error = 'error while retrieving previous version from spec file'
-        _shell_utils.print_status_output(pkg_name, is_error=True, msg=error)
+        raise BumpError('error while bumping version in spec file')
 
 
-def _download_new_sources(pkg_path, pkg_name):
-    spectool_cmd = ['/usr/bin/spectool', '--get-files', f'{pkg_name}.spec']
-    spectool_proc = run_cmd(spectool_cmd, working_directory=pkg_path, wait=True, exit_on_error=False)
+_tarball_regex = re.compile(r'^.+\-.*\.tar\.gz.*$')
+_source_cache = None
+# update-certbot-packages downloads sources from several threads which must
+# share one cache (index and per-URL locks)
+_source_cache_lock = threading.Lock()
+
+def _get_source_cache():
+    global _source_cache
+    with _source_cache_lock:
+        if _source_cache is None:
+            _source_cache = _sources.SourceCache()
+        return _source_cache
+
+
+def _list_spec_sources(pkg_path, pkg_name):
+    spectool_cmd = ['/usr/bin/spectool', '--list-files', f'{pkg_name}.spec']
+    spectool_proc = run_cmd(spectool_cmd, working_directory=pkg_path, exit_on_error=False)
     if spectool_proc.returncode != 0:
-        error = 'error while downloading new sources'
-        _shell_utils.print_status_output(pkg_name, is_error=True, msg=error)
-        return ()
-
-    stdout_str = spectool_proc.stdout.read().decode('utf8').strip()
-    filenames = set()
-    fn_patterns = (
-        #r'^Downloading: .*/(.+\-.*.tar.gz.*)$',
-        r'^Downloaded: (.+\-.*.tar.gz.*)$',
-    )
-    for line in re.split('\n', stdout_str):
-        for pattern in fn_patterns:
-            match = re.search(pattern, line)
-            if match:
-                break
-        else:
-            #print('skipping %s' % line)
-            continue
-        filename = match.group(1)
-        filenames.add(filename)
-    return tuple(filenames)
+        raise BumpError('error while listing new sources')
+    return spectool_proc.stdout.decode('utf8')
+
+
+def _download_new_sources(pkg_path, pkg_name):
+    stdout_str = _list_spec_sources(pkg_path, pkg_name)
+    sources = tuple(_sources.parse_spectool_sources(stdout_str))
+    try:
+        filenames = _get_source_cache().fetch_into(pkg_path, sources)
+    except _sources.SourceError as e:
+        raise BumpError(str(e))
+    finally:
+        _git.invalidate_repo_state(pkg_path)
+    return tuple(filename for filename in filenames if _tarball_regex.match(filename))
 
 
 def verify_gpg_signature(pkg_name, pkg_path):
-    fedpkg_prep = run_cmd(['fedpkg', 'prep'], working_directory=pkg_path, wait=True, exit_on_error=False)
+    fedpkg_prep = run_cmd(['fedpkg', 'prep'], working_directory=pkg_path, exit_on_error=False)
+    _git.invalidate_repo_state(pkg_path)
     if fedpkg_prep.returncode != 0:
-        error = 'error while running "fedpkg prep"'
-        print_status_output(pkg_name, is_error=True, msg=error)
-        has_valid_signature = False
-    else:
-        fedpkg_stderr_str = fedpkg_prep.stderr.read().decode('utf8')
-        has_valid_signature = 'gpgv: Good signature' in fedpkg_stderr_str
+        raise BumpError('error while running "fedpkg prep"')
+    fedpkg_stderr_str = fedpkg_prep.stderr.decode('utf8')
+    has_valid_signature = 'gpgv: Good signature' in fedpkg_stderr_str
     return has_valid_signature
 
 
+def check_signatures(pkg_name, pkg_path):
+    """Verify all signed sources against the keyring (without "fedpkg prep").
 
-def main():
-    arguments = docopt(__doc__)
-    pkg_name = arguments['<package>']
-    new_version = arguments['<version>']
-    bug_summary = arguments['<bug-summary>']
-    bug_id = arguments['<bug-id>']
-    upload_new_sources = not arguments['--no-upload']
+    Returns one SignatureCheck per signature file."""
+    spec_str = (Path(pkg_path) / f'{pkg_name}.spec').read_text()
+    source_files = _sources.parse_spectool_source_files(_list_spec_sources(pkg_path, pkg_name))
+    checks = _gpg.find_signature_checks(spec_str, source_files)
+    if not checks:
+        raise BumpError('no signature/keyring found in spec file')
+    return _gpg.verify_signatures(pkg_path, checks)
 
-    if bug_summary:
-        match = re.search(f'{pkg_name}\-(.+) is available', bug_summary)
-        new_version = match.group(1)
 
-    pkg_path = Path('.')
+def version_from_bug_summary(pkg_name, bug_summary):
+    match = re.search(f'{pkg_name}\-(.+) is available', bug_summary)
+    return match.group(1)
 
+
+def bump_version(pkg_path, pkg_name, new_version, bug_id=None):
+    """Update the spec file (and stage it) unless it already contains
+    "new_version". Returns (old_version, commit message) or None."""
     old_version = _spec.get_version_from_specfile(pkg_path, pkg_name)
+    if old_version is None:
+        raise BumpError('error while retrieving previous version from spec file')
     if old_version == new_version:
-        print(f'Already up to date ({old_version})')
-        return
-    print(f'{old_version} -> {new_version}')
+        return None
 
     message = f'Update to {new_version}'
     if bug_id:
         message += f' (#{bug_id})'
     _bump_spec(pkg_path, pkg_name, new_version, message)
     _git.add(pkg_path, f'{pkg_name}.spec')
+    return (old_version, message)
+
+
+def ensure_valid_signature(pkg_name, pkg_path, *, full_prep=False):
+    if full_prep:
+        if not verify_gpg_signature(pkg_name, pkg_path):
+            raise BumpError('no valid signature')
+        return
+    bad_checks = [check for check in check_signatures(pkg_name, pkg_path) if not check.is_valid]
+    if bad_checks:
+        details = ', '.join(f'{check.data_file} ({check.message})' for check in bad_checks)
+        raise BumpError(f'no valid signature: {details}')
+
+
+def upload_new_sources(pkg_path, new_sources, *, upload=True):
+    if not new_sources:
+        return
+    cmd_new_sources = ('fedpkg', 'new-sources', *new_sources)
+    if not upload:
+        print(' '.join(cmd_new_sources))
+        return
+    sources_proc = run_cmd(cmd_new_sources, working_directory=pkg_path, exit_on_error=False)
+    # "fedpkg new-sources" changes and stages "sources" and ".gitignore"
+    _git.invalidate_repo_state(pkg_path)
+    if sources_proc.returncode != 0:
+        raise BumpError('error while uploading new sources')
+
+
+def main():
+    arguments = docopt(__doc__)
+    pkg_name = arguments['<package>']
+    new_version = arguments['<version>']
+    bug_summary = arguments['<bug-summary>']
+    bug_id = arguments['<bug-id>']
+    upload = not arguments['--no-upload']
+    full_prep = arguments['--full-prep']
+
+    if bug_summary:
+        new_version = version_from_bug_summary(pkg_name, bug_summary)
+
+    pkg_path = Path('.')
 
-    new_sources = _download_new_sources(pkg_path, pkg_name)
-    #print(new_sources)
-    has_valid_signature = verify_gpg_signature(pkg_name, pkg_path)
-    if not has_valid_signature:
-        print_status_output(pkg_name, is_error=True, msg='no valid signature')
+    try:
+        bump_info = bump_version(pkg_path, pkg_name, new_version, bug_id)
+        if bump_info is None:
+            print(f'Already up to date ({new_version})')
+            return
+        old_version, message = bump_info
+        print(f'{old_version} -> {new_version}')
+
+        new_sources = _download_new_sources(pkg_path, pkg_name)
+        #print(new_sources)
+        ensure_valid_signature(pkg_name, pkg_path, full_prep=full_prep)
+        upload_new_sources(pkg_path, new_sources, upload=upload)
+    except BumpError as e:
+        print_status_output(pkg_name, is_error=True, msg=str(e))
         return
-    
-    if new_sources:
-        cmd_new_sources = ('fedpkg', 'new-sources', *new_sources)
-        if upload_new_sources:
-            sources_proc = run_cmd(cmd_new_sources, working_directory=pkg_path, wait=True, exit_on_error=False)
-            if sources_proc.returncode != 0:
-                print_status_output(pkg_name, is_error=True, msg='error while uploading new sources')
-                return
-        else:
-            print(' '.join(cmd_new_sources))
 
     _git.commit(pkg_path, message)
 
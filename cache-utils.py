@@ -0,0 +1,61 @@
+
+import json
+import os
+from pathlib import Path
+import tempfile
+import threading
+
+
+__all__ = [
+    'JSONFileCache',
+    'get_cache_dir',
+]
+
+def get_cache_dir():
+    xdg_cache_home = os.getenv('XDG_CACHE_HOME') or (Path.home() / '.cache')
+    cache_dir = Path(xdg_cache_home) / 'fedpkgscripts'
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    return cache_dir
+
+
+class JSONFileCache:
+    """Small dict-like cache which is persisted as a JSON file.
+
+    The file is loaded lazily and rewritten atomically on every update so
+    concurrent script runs never see a half-written cache. Access is
+    serialized with a lock as callers might use worker threads."""
+    def __init__(self, filename):
+        self.path = get_cache_dir() / filename
+        self._data = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._data is not None:
+            return self._data
+        try:
+            with self.path.open('r') as fp:
+                self._data = json.load(fp)
+        except (OSError, ValueError):
+            # missing or corrupted cache file: just start over
+            self._data = {}
+        return self._data
+
+    def get(self, key, default=None):
+        with self._lock:
+            return self._load().get(key, default)
+
+    def set(self, key, value):
+        with self._lock:
+            self._load()[key] = value
+            self._save()
+
+    def delete(self, key):
+        with self._lock:
+            if self._load().pop(key, None) is not None:
+                self._save()
+
+    def _save(self):
+        fd, tmp_name = tempfile.mkstemp(dir=self.path.parent, prefix=self.path.name, suffix='.tmp')
+        with os.fdopen(fd, 'w') as fp:
+            json.dump(self._data, fp, indent=1, sort_keys=True)
+        os.replace(tmp_name, self.path)
@@ -3,11 +3,21 @@
 check-for-uncommitted-changes.py
 
 Usage:
-    check-for-uncommitted-changes.py [--with-version] [<pkg>...]
+    check-for-uncommitted-changes.py [--with-version] [--jobs=<N>] [<pkg>...]
+    check-for-uncommitted-changes.py --version-matrix [--branches=<BRANCHES>] [--jobs=<N>] [<pkg>...]
+
+Options:
+  --jobs=<N>                number of packages to process in parallel [default: 1]
+  --version-matrix          show the spec version of every branch (read from
+                            git objects, no checkout needed) and how many
+                            commits each branch is ahead/behind origin
+  --branches=<BRANCHES>     comma-separated branches for --version-matrix [default: rawhide,f34,f33,epel8,epel7]
 """
 
+from concurrent.futures import ThreadPoolExecutor
 import importlib
 from pathlib import Path
+import sys
 
 try:
     from docopt import docopt
@@ -16,9 +26,11 @@ except ImportError:
     sys.exit(1)
 
 _git = importlib.import_module('git-utils')
+_git_batch = importlib.import_module('git-batch-utils')
+_parallel = importlib.import_module('parallel-utils')
+PackageResult = _parallel.PackageResult
 _shell_utils = importlib.import_module('shell-utils')
 display_output = _shell_utils.display_output
-print_status_output = _shell_utils.print_status_output
 sanitize_pkg_names = _shell_utils.sanitize_pkg_names
 _pkg_list = importlib.import_module('pkg-list')
 parse_package_list = _pkg_list.parse_package_list
@@ -27,12 +39,77 @@ _spec = importlib.import_module('spec-utils')
 THIS_DIR = Path(__file__).parent.resolve()
 
 
+# many branches share the same spec file
+_versions_by_blob = {}
+
+def _spec_version(cat_file, branch, pkg_name):
+    obj = cat_file.read(f'refs/heads/{branch}:{pkg_name}.spec')
+    if obj is None:
+        return '?'
+    blob_sha, _, spec_bytes = obj
+    if blob_sha not in _versions_by_blob:
+        try:
+            _versions_by_blob[blob_sha] = _spec.parse_spec_version(spec_bytes.decode('utf8'))
+        except (_spec.UnresolvableSpec, UnicodeDecodeError):
+            _versions_by_blob[blob_sha] = '?'
+    return _versions_by_blob[blob_sha]
+
+
+def branch_versions(pkg_name, branches):
+    """Return {branch: "<version> (+ahead/-behind)"} read from the git objects
+    of all branches via a single "git cat-file" process."""
+    pkg_path = (THIS_DIR / '..' / pkg_name).resolve()
+    if not pkg_path.is_dir():
+        return {branch: '-' for branch in branches}
+    cat_file = _git_batch.get_cat_file(pkg_path)
+    cells = {}
+    for branch in branches:
+        local = cat_file.read(f'refs/heads/{branch}')
+        if local is None:
+            cells[branch] = '-'
+            continue
+        cell = _spec_version(cat_file, branch, pkg_name)
+        remote = cat_file.read(f'refs/remotes/origin/{branch}')
+        if remote is not None:
+            try:
+                ahead, behind = _git_batch.ahead_behind(cat_file, local[0], remote[0])
+            except _git_batch.MissingObject:
+                # shallow clone
+                cell += ' (?)'
+                ahead = behind = 0
+            counts = ([f'+{ahead}'] if ahead else []) + ([f'-{behind}'] if behind else [])
+            if counts:
+                cell += f' ({"/".join(counts)})'
+        cells[branch] = cell
+    return cells
+
+
+def print_version_matrix(pkgs, branches, *, jobs):
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        rows = list(executor.map(lambda pkg_name: branch_versions(pkg_name, branches), pkgs))
+    _git_batch.close_all()
+    name_width = max(len(pkg_name) for pkg_name in ['package'] + pkgs)
+    widths = {
+        branch: max(len(branch), *(len(cells[branch]) for cells in rows))
+        for branch in branches
+    }
+    print('  '.join(['package'.ljust(name_width)] + [branch.ljust(widths[branch]) for branch in branches]).rstrip())
+    for pkg_name, cells in zip(pkgs, rows):
+        print('  '.join([pkg_name.ljust(name_width)] + [cells[branch].ljust(widths[branch]) for branch in branches]).rstrip())
+
+
 def main():
     arguments = docopt(__doc__)
     show_version = arguments['--with-version']
     pkgs = sanitize_pkg_names(arguments['<pkg>']) or parse_package_list('CERTBOT-ALL-PACKAGES-AND-PLUGINS.txt')
 
-    for pkg_name in pkgs:
+    jobs = _parallel.parse_jobs(arguments['--jobs'])
+    if arguments['--version-matrix']:
+        branches = [branch.strip() for branch in arguments['--branches'].split(',') if branch.strip()]
+        print_version_matrix(pkgs, branches, jobs=jobs)
+        return
+
+    def check_package(pkg_name):
         pkg_path = (THIS_DIR / '..' / pkg_name).resolve()
 
         if show_version:
@@ -43,9 +120,10 @@ def main():
 
         if _git.has_uncommitted_changes(pkg_path):
             error_msg = 'uncommitted changes'
-            print_status_output(pkg_str, is_warning=True, msg=error_msg)
-        else:
-            print_status_output(pkg_str)
+            return PackageResult(pkg_str, is_warning=True, msg=error_msg)
+        return PackageResult(pkg_str)
+
+    _parallel.process_packages(check_package, pkgs, jobs=jobs, show_progress=False)
 
 if __name__ == '__main__':
     main()
@@ -8,6 +8,10 @@ Usage:
 
 Options:
     --close-bugs
+    --refresh              ignore cached bugzilla results
+    --bugzilla-ttl=<MIN>   reuse cached bugzilla results for <MIN> minutes [default: 60]
+    --koji-hub=<URL>       Koji XML-RPC hub [default: https://koji.fedoraproject.org/kojihub]
+    --trace=<FILE>         write a Chrome trace of all commands and print a timing summary
 
 """
 
@@ -31,7 +35,9 @@ except ImportError:
 
 _bz = importlib.import_module('bugzilla-utils')
 _git = importlib.import_module('git-utils')
+_koji = importlib.import_module('koji-utils')
 _shell_utils = importlib.import_module('shell-utils')
+_trace = importlib.import_module('trace-utils')
 display_output = _shell_utils.display_output
 print_status_output = _shell_utils.print_status_output
 run_cmd = _shell_utils.run_cmd
@@ -56,40 +62,21 @@ DIST_MAP = {
     'el7'  : 'el7',
 }
 
-def _extract_build_info(pkg_name, dist, koji_stdout):
-    build_regex = re.compile(f'^({pkg_name}.+?\.{dist})\s+')
-    for koji_line in koji_stdout.split('\n'):
-        match = build_regex.search(koji_line)
-        if not match:
-            continue
-        build = match.group(1)
-        yield build
+_dist_pattern = f'\.({"|".join(DIST_MAP.values())})'
+_version_regex = re.compile(f'\-(\d.+?)\-\d{_dist_pattern}')
 
-def query_koji(pkg_name, dist):
+def query_koji(koji_hub, pkg_names, dist):
+    """Return the latest COMPLETE build for each package (or None).
+
+    All packages are looked up with a single Koji multicall."""
     today = Date.today()
     last_week = (today - TimeDelta(days=7))
-    koji_cmd = [
-        '/usr/bin/koji',
-        'list-builds',
-        f'--package={pkg_name}',
-        '--reverse',
-        '--state=COMPLETE',
-        '--quiet',
-        f'--after={last_week.isoformat()}',
-    ]
-    koji_proc = run_cmd(koji_cmd, wait=True)
-    koji_stdout = koji_proc.stdout.read().decode('utf8')
-    assert koji_proc.returncode == 0
-
-    builds = tuple(_extract_build_info(pkg_name, dist, koji_stdout))
-    if not builds:
-        return None
-    return builds[0]
+    recent_builds = koji_hub.list_recent_builds(pkg_names, created_after=last_week)
+    build_index = _koji.index_builds(recent_builds)
+    return {pkg_name: build_index.get((pkg_name, dist)) for pkg_name in pkg_names}
 
 def version_from_build(build):
-    dist_pattern = f'\.({"|".join(DIST_MAP.values())})'
-    version_pattern = f'\-(\d.+?)\-\d{dist_pattern}'
-    match = re.search(version_pattern, build)
+    match = _version_regex.search(build)
     new_version = match.group(1)
     return new_version
 
@@ -115,8 +102,8 @@ def submit_bodji_update(builds, bug_ids=(), autokarma=False, is_dry_run=False):
         shlex_join = subprocess.list2cmdline
         print(shlex_join(bodhi_cmd))
         return
-    bodji_proc = run_cmd(bodhi_cmd, wait=True)
-    bodhi_stdout = bodji_proc.stdout.read().decode('utf8')
+    bodji_proc = run_cmd(bodhi_cmd)
+    bodhi_stdout = bodji_proc.stdout.decode('utf8')
     assert bodji_proc.returncode == 0
     print(bodhi_stdout)
 
@@ -127,13 +114,19 @@ def main():
     pkg_names = sanitize_pkg_names(arguments['<pkg>'])
     is_dry_run = not arguments['--do']
     close_bugs = arguments['--close-bugs']
+    if arguments['--trace']:
+        _trace.enable_tracing(arguments['--trace'])
+    refresh = arguments['--refresh']
+    bugzilla_ttl = int(arguments['--bugzilla-ttl']) * 60
     if not pkg_names:
         pkg_names = parse_package_list('CERTBOT-ALL-PACKAGES-AND-PLUGINS.txt')
 
     dist = DIST_MAP[branch_name]
+    koji_hub = _koji.KojiHub(arguments['--koji-hub'])
+    latest_builds = query_koji(koji_hub, pkg_names, dist)
     pkg_builds = {}
     for pkg_name in pkg_names:
-        build = query_koji(pkg_name, dist)
+        build = latest_builds[pkg_name]
         if build is None:
             print_status_output(pkg_name, is_error=True, msg='no build found')
         pkg_builds[pkg_name] = build
@@ -141,7 +134,7 @@ def main():
 
     bug_ids = ()
     if close_bugs:
-        pkg_data = _bz.retrieve_release_notification_bugs(pkg_names)
+        pkg_data = _bz.retrieve_release_notification_bugs(pkg_names, refresh=refresh, cache_ttl=bugzilla_ttl)
         bug_ids = tuple(map(itemgetter(1), pkg_data.values()))
         if is_dry_run:
             for pkg_name, (bug_summary, bug_id) in pkg_data.items():
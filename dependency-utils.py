@@ -0,0 +1,65 @@
+
+import importlib
+from pathlib import Path
+
+
+__all__ = [
+    'DependencyCycle',
+    'build_layers',
+    'read_build_dependencies',
+]
+
+_spec = importlib.import_module('spec-utils')
+
+
+class DependencyCycle(Exception):
+    pass
+
+
+def _read_relations(pkg_path):
+    spec_path = Path(pkg_path) / f'{Path(pkg_path).name}.spec'
+    try:
+        spec_str = spec_path.read_text()
+    except (OSError, UnicodeDecodeError):
+        return (set(), set())
+    return _spec.parse_package_relations(spec_str)
+
+
+def read_build_dependencies(pkg_paths, *, declared=None):
+    """Return {package name: set of package names which must be built first}.
+
+    Edges are derived from the BuildRequires in the spec files (only
+    dependencies between the given packages matter). "declared" can add
+    edges which are not visible in the specs (see pkg-list).
+    """
+    pkg_names = [Path(pkg_path).name for pkg_path in pkg_paths]
+    relations = {Path(pkg_path).name: _read_relations(pkg_path) for pkg_path in pkg_paths}
+    provided_by = {}
+    for pkg_name, (provides, _) in relations.items():
+        for provide in provides:
+            provided_by[provide] = pkg_name
+
+    dependencies = {}
+    for pkg_name, (_, build_requires) in relations.items():
+        required_pkgs = {provided_by[name] for name in build_requires if name in provided_by}
+        required_pkgs.update((declared or {}).get(pkg_name, ()))
+        required_pkgs.discard(pkg_name)
+        dependencies[pkg_name] = required_pkgs.intersection(pkg_names)
+    return dependencies
+
+
+def build_layers(dependencies):
+    """Split packages into layers so each package only depends on packages in
+    earlier layers. All packages in one layer can be built concurrently."""
+    remaining = {pkg_name: set(required) for pkg_name, required in dependencies.items()}
+    layers = []
+    while remaining:
+        layer = sorted(pkg_name for pkg_name, required in remaining.items() if not required)
+        if not layer:
+            raise DependencyCycle('dependency cycle between ' + ', '.join(sorted(remaining)))
+        for pkg_name in layer:
+            del remaining[pkg_name]
+        for required in remaining.values():
+            required.difference_update(layer)
+        layers.append(layer)
+    return layers
@@ -0,0 +1,462 @@
+
+from dataclasses import dataclass
+import hashlib
+import heapq
+import importlib
+import os
+from pathlib import Path
+import stat
+import struct
+import threading
+
+
+__all__ = [
+    'CatFile',
+    'Commit',
+    'HashObject',
+    'MissingObject',
+    'UnsupportedRepository',
+    'ahead_behind',
+    'changed_files',
+    'close_all',
+    'get_cat_file',
+    'get_hash_object',
+    'is_ancestor',
+    'read_head',
+    'read_ref',
+    'read_refs',
+]
+
+_shell_utils = importlib.import_module('shell-utils')
+_trace = importlib.import_module('trace-utils')
+
+
+class UnsupportedRepository(Exception):
+    """The repository layout can not be read in-process (e.g. a linked
+    worktree or reftable), callers should ask git instead."""
+    pass
+
+
+class MissingObject(Exception):
+    """A commit which is needed for a history walk is not available locally
+    (shallow clone or a sha which was never fetched)."""
+    pass
+
+
+@dataclass
+class Commit:
+    sha        : str
+    parents    : tuple
+    commit_time: int
+
+
+def parse_commit(sha, data):
+    parents = []
+    commit_time = 0
+    for line in data.split(b'\n'):
+        if not line:
+            # end of the header, the message follows
+            break
+        if line.startswith(b'parent '):
+            parents.append(line[7:].decode('ascii'))
+        elif line.startswith(b'committer '):
+            # "committer Name <email> 1618000000 +0200"
+            commit_time = int(line.rsplit(b' ', 2)[1])
+    return Commit(sha, tuple(parents), commit_time)
+
+
+class _Coprocess:
+    """A long-lived git process which answers one request per stdin line.
+    Requests are serialized so instances are safe to use from worker threads."""
+    def __init__(self, repo_path, cmd):
+        self.repo_path = Path(repo_path)
+        self._cmd = tuple(cmd)
+        self._start = _trace.now()
+        self._proc = _shell_utils.start_coprocess(self._cmd, working_directory=self.repo_path)
+        self._lock = threading.Lock()
+        self._n_bytes = 0
+
+    def is_alive(self):
+        return (self._proc.poll() is None)
+
+    def _request(self, line):
+        self._proc.stdin.write(line + b'\n')
+        self._proc.stdin.flush()
+        response = self._proc.stdout.readline()
+        if not response:
+            raise OSError(f'{" ".join(self._cmd)} terminated in {self.repo_path}')
+        return response
+
+    def close(self):
+        if self.is_alive():
+            self._proc.stdin.close()
+            self._proc.wait()
+            _trace.record_command(
+                self._cmd,
+                start=self._start,
+                cwd=self.repo_path,
+                returncode=self._proc.returncode,
+                output_bytes=self._n_bytes,
+            )
+
+
+class CatFile(_Coprocess):
+    """A "git cat-file --batch" process which stays alive for all object
+    lookups in one repository (instead of one git process per lookup)."""
+    def __init__(self, repo_path):
+        super().__init__(repo_path, ('/usr/bin/git', 'cat-file', '--batch'))
+        self._commits = {}
+
+    def read(self, rev):
+        """Return (sha, type, content) of an object. "rev" is anything git
+        can resolve (e.g. "refs/heads/f34" or "f34:certbot.spec").
+        Returns None if there is no such object."""
+        assert '\n' not in rev
+        with self._lock:
+            fields = self._request(rev.encode('utf8')).split()
+            # "<rev> missing" or "<rev> ambiguous"
+            if len(fields) != 3:
+                return None
+            sha, type_, size = fields
+            content = self._proc.stdout.read(int(size))
+            # every object is followed by a newline
+            self._proc.stdout.read(1)
+            self._n_bytes += len(content)
+        return (sha.decode('ascii'), type_.decode('ascii'), content)
+
+    def read_blob(self, rev):
+        obj = self.read(rev)
+        if (obj is None) or (obj[1] != 'blob'):
+            return None
+        return obj[2]
+
+    def read_commit(self, rev):
+        """Return the Commit, raises MissingObject if it is not available
+        (e.g. in a shallow clone)."""
+        if rev in self._commits:
+            return self._commits[rev]
+        obj = self.read(rev)
+        if (obj is None) or (obj[1] != 'commit'):
+            raise MissingObject(f'no commit {rev} in {self.repo_path}')
+        commit = parse_commit(obj[0], obj[2])
+        # commits are immutable so only lookups by sha can be cached
+        self._commits[commit.sha] = commit
+        return commit
+
+
+class HashObject(_Coprocess):
+    """A "git hash-object --stdin-paths" process. git applies the line ending
+    conversion and clean filters configured for the repository (in any
+    config or attributes file) just like "git status" does."""
+    def __init__(self, repo_path):
+        super().__init__(repo_path, ('/usr/bin/git', 'hash-object', '--stdin-paths'))
+
+    def hash_path(self, path):
+        """Return the blob sha of a work tree file ("path" relative to the
+        repository, as bytes)."""
+        if path.startswith(b'"') or (b'\n' in path):
+            # git would unquote such paths
+            raise UnsupportedRepository(f'unsupported file name {path!r}')
+        with self._lock:
+            response = self._request(path)
+            self._n_bytes += len(response)
+        return response.strip().decode('ascii')
+
+
+_LEFT = 1
+_RIGHT = 2
+
+def ahead_behind(cat_file, left_sha, right_sha):
+    """Return (commits only in left, commits only in right) like
+    "git rev-list --left-right --count left...right" does.
+
+    Walks the history from both sides (newest commit first) only until the
+    merge base is reached so diverged branches are cheap to compare. Like
+    older git versions this relies on sane commit timestamps. Raises
+    MissingObject if a needed commit is not available."""
+    if left_sha == right_sha:
+        return (0, 0)
+    flags = {left_sha: _LEFT, right_sha: _RIGHT}
+    queue = []
+    for sha in (left_sha, right_sha):
+        heapq.heappush(queue, (-cat_file.read_commit(sha).commit_time, sha))
+
+    def has_interesting_commits():
+        return any(flags[sha] != (_LEFT | _RIGHT) for _, sha in queue)
+
+    while queue and has_interesting_commits():
+        _, sha = heapq.heappop(queue)
+        commit = cat_file.read_commit(sha)
+        for parent_sha in commit.parents:
+            parent_flags = flags.get(parent_sha, 0)
+            if parent_flags | flags[sha] == parent_flags:
+                continue
+            flags[parent_sha] = parent_flags | flags[sha]
+            # (again) if new flags must be passed on to its ancestors
+            parent = cat_file.read_commit(parent_sha)
+            heapq.heappush(queue, (-parent.commit_time, parent_sha))
+    ahead = sum(1 for value in flags.values() if value == _LEFT)
+    behind = sum(1 for value in flags.values() if value == _RIGHT)
+    return (ahead, behind)
+
+
+# commits may be older than their parents if the clocks of the committers
+# differ, walks only stop this far below the timestamp they look for
+_CLOCK_SKEW = 24 * 3600
+
+def is_ancestor(cat_file, ancestor_sha, descendant_sha):
+    """Same as "git merge-base --is-ancestor" but without a new process.
+
+    The walk starts at the newest commits and stops at commits which are
+    (clearly) older than the ancestor so the common cases (ancestor close to
+    the descendant or a diverged branch) only read recent history. Raises
+    MissingObject if a needed commit is not available."""
+    if ancestor_sha == descendant_sha:
+        return True
+    cutoff = cat_file.read_commit(ancestor_sha).commit_time - _CLOCK_SKEW
+    descendant = cat_file.read_commit(descendant_sha)
+    seen = {descendant_sha}
+    queue = [(-descendant.commit_time, descendant_sha)]
+    while queue:
+        _, sha = heapq.heappop(queue)
+        for parent_sha in cat_file.read_commit(sha).parents:
+            if parent_sha == ancestor_sha:
+                return True
+            if parent_sha in seen:
+                continue
+            seen.add(parent_sha)
+            parent = cat_file.read_commit(parent_sha)
+            if parent.commit_time >= cutoff:
+                heapq.heappush(queue, (-parent.commit_time, parent_sha))
+    return False
+
+
+# --- refs ---------------------------------------------------------------------
+def _git_dir(repo_path):
+    git_dir = Path(repo_path) / '.git'
+    if not git_dir.is_dir():
+        raise UnsupportedRepository(f'{git_dir} is not a directory')
+    if (git_dir / 'reftable').exists():
+        raise UnsupportedRepository(f'{repo_path} uses reftable')
+    return git_dir
+
+def _read_packed_refs(git_dir):
+    packed_refs = {}
+    try:
+        lines = (git_dir / 'packed-refs').read_text().splitlines()
+    except FileNotFoundError:
+        return packed_refs
+    for line in lines:
+        # "# pack-refs with: …" header, "^<sha>" lines are peeled tags
+        if line.startswith(('#', '^')) or (' ' not in line):
+            continue
+        sha, refname = line.split(' ', 1)
+        packed_refs[refname] = sha
+    return packed_refs
+
+def _resolve(git_dir, refname, packed_refs, *, depth=0):
+    if depth > 5:
+        raise UnsupportedRepository(f'symbolic ref {refname} nested too deep')
+    try:
+        content = (git_dir / refname).read_text().strip()
+    except (FileNotFoundError, NotADirectoryError, IsADirectoryError):
+        if packed_refs is None:
+            packed_refs = _read_packed_refs(git_dir)
+        return packed_refs.get(refname)
+    if content.startswith('ref: '):
+        return _resolve(git_dir, content[5:], packed_refs, depth=depth+1)
+    return content or None
+
+def read_ref(repo_path, refname):
+    """Return the sha of a ref like "refs/heads/f34" (None if it does not
+    exist) by reading the loose ref or packed-refs directly."""
+    return _resolve(_git_dir(repo_path), refname, None)
+
+def read_refs(repo_path, refnames):
+    """Return {refname: sha or None} (packed-refs is read at most once)."""
+    git_dir = _git_dir(repo_path)
+    packed_refs = _read_packed_refs(git_dir)
+    return {refname: _resolve(git_dir, refname, packed_refs) for refname in refnames}
+
+def read_head(repo_path):
+    """Return (branch, sha) of HEAD. "branch" is None if HEAD is detached,
+    "sha" is None for a branch without commits."""
+    git_dir = _git_dir(repo_path)
+    head = (git_dir / 'HEAD').read_text().strip()
+    if not head.startswith('ref: '):
+        return (None, head)
+    refname = head[5:]
+    branch = refname[len('refs/heads/'):] if refname.startswith('refs/heads/') else None
+    return (branch, _resolve(git_dir, refname, None))
+
+
+# --- index --------------------------------------------------------------------
+@dataclass
+class IndexEntry:
+    path    : bytes
+    mode    : int
+    sha     : str
+    size    : int
+    mtime_ns: int
+    ctime_ns: int
+    ino     : int
+    stage   : int
+    skip    : bool    # assume-valid or skip-worktree: git ignores the work tree
+
+
+_ENTRY_HEADER = struct.Struct('>10I20sH')
+_ASSUME_VALID = 0x8000
+_EXTENDED = 0x4000
+_SKIP_WORKTREE = 0x4000
+
+def _read_varint(data, offset):
+    # offset encoding of index v4 (not LEB128, see varint.c in git)
+    byte = data[offset]
+    offset += 1
+    value = byte & 0x7f
+    while byte & 0x80:
+        byte = data[offset]
+        offset += 1
+        value = ((value + 1) << 7) | (byte & 0x7f)
+    return value, offset
+
+def parse_index(data):
+    """Return the entries of a git index file (versions 2 to 4)."""
+    signature, version, n_entries = struct.unpack_from('>4sII', data)
+    if (signature != b'DIRC') or (version not in (2, 3, 4)):
+        raise UnsupportedRepository(f'unsupported index version {version}')
+    entries = []
+    offset = 12
+    previous_path = b''
+    for _ in range(n_entries):
+        fields = _ENTRY_HEADER.unpack_from(data, offset)
+        ctime_s, ctime_ns, mtime_s, mtime_ns, _, ino, mode, _, _, size, sha, flags = fields
+        entry_start = offset
+        offset += _ENTRY_HEADER.size
+        extended_flags = 0
+        if flags & _EXTENDED:
+            extended_flags, = struct.unpack_from('>H', data, offset)
+            offset += 2
+        if version == 4:
+            strip_length, offset = _read_varint(data, offset)
+            name_end = data.index(b'\0', offset)
+            path = previous_path[:len(previous_path) - strip_length] + data[offset:name_end]
+            offset = name_end + 1
+        else:
+            name_end = data.index(b'\0', offset)
+            path = data[offset:name_end]
+            # entries are padded with 1-8 NUL bytes to a multiple of 8 bytes
+            offset = entry_start + ((name_end - entry_start + 8) & ~7)
+        previous_path = path
+        entries.append(IndexEntry(
+            path=path,
+            mode=mode,
+            sha=sha.hex(),
+            size=size,
+            mtime_ns=mtime_s * 10**9 + mtime_ns,
+            ctime_ns=ctime_s * 10**9 + ctime_ns,
+            ino=ino,
+            stage=(flags >> 12) & 0x3,
+            skip=bool((flags & _ASSUME_VALID) or (extended_flags & _SKIP_WORKTREE)),
+        ))
+    # split and sparse indexes store entries elsewhere
+    while offset + 8 <= len(data) - 20:
+        signature, size = struct.unpack_from('>4sI', data, offset)
+        if signature in (b'link', b'sdir'):
+            raise UnsupportedRepository(f'index extension {signature.decode("ascii")}')
+        offset += 8 + size
+    return entries
+
+
+def _uses_sha256(git_dir):
+    # the index layout differs (extensions.objectFormat is always stored in
+    # the repository config)
+    try:
+        config = (git_dir / 'config').read_text(errors='replace').lower()
+    except OSError:
+        return False
+    return ('objectformat' in config)
+
+
+def _is_changed(repo_path, entry, index_mtime_ns):
+    file_path = os.path.join(os.fsencode(repo_path), entry.path)
+    try:
+        file_stat = os.lstat(file_path)
+    except FileNotFoundError:
+        return True
+    if stat.S_IFMT(file_stat.st_mode) != stat.S_IFMT(entry.mode):
+        return True
+    if stat.S_ISREG(file_stat.st_mode) and ((file_stat.st_mode & 0o100) != (entry.mode & 0o100)):
+        return True
+    # same as git: a different size means the file changed unless the size
+    # in the index was reset (for "racily clean" entries)
+    if (file_stat.st_size != entry.size) and (entry.size != 0):
+        return True
+    stat_matches = (file_stat.st_mtime_ns == entry.mtime_ns) and \
+        (file_stat.st_ino == entry.ino) and (file_stat.st_size == entry.size)
+    # "racily clean": the file might have changed within the same timestamp
+    # granularity after the index was written
+    if stat_matches and (entry.mtime_ns < index_mtime_ns):
+        return False
+    if stat.S_ISLNK(file_stat.st_mode):
+        # no conversion applies to symlinks ("git hash-object" would follow them)
+        target = os.readlink(file_path)
+        blob_sha = hashlib.sha1(b'blob %d\0' % len(target) + target).hexdigest()
+    else:
+        blob_sha = get_hash_object(repo_path).hash_path(entry.path)
+    return (blob_sha != entry.sha)
+
+def changed_files(repo_path):
+    """Return the tracked files whose work tree content differs from the index
+    (like the work tree column of "git status") by reading the index directly.
+
+    Only files whose stat data does not match the index are hashed (by git
+    so content filters are honored). Raises UnsupportedRepository for
+    anything git status would have to handle specially (unmerged files,
+    submodules, sha256 …)."""
+    git_dir = _git_dir(repo_path)
+    index_path = git_dir / 'index'
+    try:
+        index_mtime_ns = index_path.stat().st_mtime_ns
+        data = index_path.read_bytes()
+    except FileNotFoundError:
+        # no index: nothing was ever staged
+        return ()
+    if _uses_sha256(git_dir):
+        raise UnsupportedRepository(f'{repo_path} uses sha256')
+    entries = parse_index(data)
+    changed = []
+    for entry in entries:
+        if entry.stage or (stat.S_IFMT(entry.mode) == 0o160000):
+            raise UnsupportedRepository(f'{repo_path} has unmerged files or submodules')
+        if not entry.skip and _is_changed(repo_path, entry, index_mtime_ns):
+            changed.append(entry.path.decode('utf8', 'surrogateescape'))
+    return tuple(changed)
+
+
+_coprocesses = {}
+_coprocesses_lock = threading.Lock()
+
+def _get_coprocess(coprocess_class, repo_path):
+    key = (coprocess_class, str(Path(repo_path).resolve()))
+    with _coprocesses_lock:
+        coprocess = _coprocesses.get(key)
+        # git exits on invalid requests (e.g. a file which vanished)
+        if (coprocess is None) or not coprocess.is_alive():
+            coprocess = coprocess_class(key[1])
+            _coprocesses[key] = coprocess
+        return coprocess
+
+def get_cat_file(repo_path):
+    """Return the shared CatFile for a repository (started on first use)."""
+    return _get_coprocess(CatFile, repo_path)
+
+def get_hash_object(repo_path):
+    return _get_coprocess(HashObject, repo_path)
+
+@_trace.register_exit_handler
+def close_all():
+    with _coprocesses_lock:
+        for coprocess in _coprocesses.values():
+            coprocess.close()
+        _coprocesses.clear()
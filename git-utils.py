@@ -1,45 +1,315 @@
 
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 import importlib
 from pathlib import Path
 
 
-__all__ = ['has_uncommitted_changes']
+__all__ = [
+    'NotFastForward',
+    'Prefetch',
+    'RepoState',
+    'fast_forward_branch',
+    'get_repo_state',
+    'has_uncommitted_changes',
+    'has_unpushed_changes',
+    'head_sha',
+    'invalidate_repo_state',
+]
 
+_cache_utils = importlib.import_module('cache-utils')
+_git_batch = importlib.import_module('git-batch-utils')
 _shell_utils = importlib.import_module('shell-utils')
 
 display_output = _shell_utils.display_output
 run_cmd = _shell_utils.run_cmd
 
+
+class NotFastForward(Exception):
+    pass
+
+
+@dataclass
+class RepoState:
+    head    : str                # None for a repo without commits
+    branch  : str                # None if HEAD is detached
+    upstream: str   = None
+    ahead   : int   = None       # None if there is no upstream branch
+    behind  : int   = None
+    dirty_files    : tuple = ()  # tracked files with changes in the work tree
+    staged_files   : tuple = ()
+    untracked_files: tuple = ()
+    unmerged_files : tuple = ()
+
+    @property
+    def has_uncommitted_changes(self):
+        return bool(self.dirty_files)
+
+    @property
+    def has_unpushed_changes(self):
+        if self.ahead is None:
+            # nothing was pushed yet
+            return True
+        return (self.ahead > 0)
+
+
+def parse_status_output(status_bytes):
+    """Parse the output of "git status --porcelain=v2 --branch -z"."""
+    headers = {}
+    dirty, staged, untracked, unmerged = [], [], [], []
+    entries = iter(status_bytes.decode('utf8', 'surrogateescape').split('\0'))
+    for entry in entries:
+        if not entry:
+            continue
+        if entry.startswith('# '):
+            key, _, value = entry[2:].partition(' ')
+            headers[key] = value
+            continue
+        entry_type = entry[0]
+        if entry_type == '?':
+            untracked.append(entry[2:])
+            continue
+        elif entry_type == '!':
+            continue
+        # "1 XY sub mH mI mW hH hI path", "2 ... score path" + NUL + origPath,
+        # "u XY sub m1 m2 m3 mW h1 h2 h3 path"
+        n_fields = {'1': 9, '2': 10, 'u': 11}[entry_type]
+        fields = entry.split(' ', n_fields - 1)
+        xy, path = fields[1], fields[-1]
+        if entry_type == '2':
+            next(entries)  # original path of a rename/copy
+        if entry_type == 'u':
+            unmerged.append(path)
+            continue
+        if xy[0] != '.':
+            staged.append(path)
+        if xy[1] != '.':
+            dirty.append(path)
+
+    head = headers.get('branch.oid')
+    branch = headers.get('branch.head')
+    ahead = behind = None
+    if 'branch.ab' in headers:
+        ahead_str, behind_str = headers['branch.ab'].split()
+        ahead, behind = int(ahead_str), abs(int(behind_str))
+    return RepoState(
+        head=None if head == '(initial)' else head,
+        branch=None if branch == '(detached)' else branch,
+        upstream=headers.get('branch.upstream'),
+        ahead=ahead,
+        behind=behind,
+        dirty_files=tuple(dirty),
+        staged_files=tuple(staged),
+        untracked_files=tuple(untracked),
+        unmerged_files=tuple(unmerged),
+    )
+
+
+# Read-only queries are answered in-process (refs, index) or by the shared
+# "git cat-file" process of the repository (objects). Only commands which
+# change the repository (and "git status" for the full RepoState) start a
+# new git process. Repositories which can not be read in-process (see
+# git-batch-utils.UnsupportedRepository) fall back to git commands.
+
+# snapshots are shared by all callers during a script run and discarded by
+# every helper which changes the repository. Code which changes the work tree
+# with other tools (rpmdev-bumpspec, fedpkg …) must call
+# invalidate_repo_state() itself.
+_repo_states = {}
+
+def _state_key(pkg_path):
+    return str(Path(pkg_path).resolve())
+
+def invalidate_repo_state(pkg_path):
+    _repo_states.pop(_state_key(pkg_path), None)
+
+def get_repo_state(pkg_path, *, refresh=False):
+    key = _state_key(pkg_path)
+    state = _repo_states.get(key)
+    if (state is None) or refresh:
+        cmd = ['/usr/bin/git', 'status', '--porcelain=v2', '--branch', '-z']
+        result = run_cmd(cmd, working_directory=pkg_path)
+        state = parse_status_output(result.stdout)
+        _repo_states[key] = state
+    return state
+
+
 def add(pkg_path, file):
-    run_cmd(['/usr/bin/git', 'add', file], working_directory=pkg_path, wait=True)
+    run_cmd(['/usr/bin/git', 'add', file], working_directory=pkg_path)
+    invalidate_repo_state(pkg_path)
 
 def commit(pkg_path, message):
-    run_cmd(['/usr/bin/git', 'commit', '-m', message], working_directory=pkg_path, wait=True)
+    run_cmd(['/usr/bin/git', 'commit', '-m', message], working_directory=pkg_path)
+    invalidate_repo_state(pkg_path)
 
 
 def has_uncommitted_changes(pkg_path):
-    proc = run_cmd(['/usr/bin/git', 'ls-files', '--modified'], working_directory=pkg_path, wait=True)
-    return bool(proc.stdout.read())
+    if _state_key(pkg_path) not in _repo_states:
+        try:
+            return bool(_git_batch.changed_files(pkg_path))
+        except _git_batch.UnsupportedRepository:
+            pass
+    return get_repo_state(pkg_path).has_uncommitted_changes
 
 def has_unpushed_changes(pkg_path):
-    proc = run_cmd(['/usr/bin/git', 'cherry'], working_directory=pkg_path, wait=True)
-    return bool(proc.stdout.read())
+    return get_repo_state(pkg_path).has_unpushed_changes
+
+def _read_head(pkg_path):
+    state = _repo_states.get(_state_key(pkg_path))
+    if state is None:
+        try:
+            return _git_batch.read_head(pkg_path)
+        except _git_batch.UnsupportedRepository:
+            state = get_repo_state(pkg_path)
+    return (state.branch, state.head)
+
+def head_sha(pkg_path):
+    """Return the commit sha of HEAD (None for a repo without commits)."""
+    return _read_head(pkg_path)[1]
 
-def fetch_remote_changes(pkg_path):
-    proc = run_cmd(['/usr/bin/git', 'fetch'], working_directory=pkg_path, wait=True)
-    fetched_new_changes = bool(proc.stdout.read())
+def current_branch(pkg_path):
+    return _read_head(pkg_path)[0]
+
+def _read_refs(pkg_path, refnames):
+    try:
+        return _git_batch.read_refs(pkg_path, refnames)
+    except _git_batch.UnsupportedRepository:
+        pass
+    cmd = ['/usr/bin/git', 'for-each-ref', '--format=%(refname) %(objectname)', *refnames]
+    result = run_cmd(cmd, working_directory=pkg_path)
+    shas = dict(line.split(' ', 1) for line in result.stdout.decode('utf8').splitlines())
+    return {refname: shas.get(refname) for refname in refnames}
+
+def branch_sha(branch, pkg_path):
+    """Return the commit sha of a local branch (None if it does not exist)."""
+    refname = f'refs/heads/{branch}'
+    return _read_refs(pkg_path, [refname])[refname]
+
+def fetch_remote_changes(pkg_path, *, remote=None, exit_on_error=True):
+    """Return True if new changes were fetched (None if the fetch failed and
+    "exit_on_error" is False)."""
+    cmd = ['/usr/bin/git', '-c', f'core.sshCommand={_ssh_command()}', 'fetch']
+    if remote:
+        cmd.append(remote)
+    result = run_cmd(cmd, working_directory=pkg_path, exit_on_error=exit_on_error)
+    invalidate_repo_state(pkg_path)
+    if result.returncode != 0:
+        return None
+    fetched_new_changes = bool(result.stdout)
     return fetched_new_changes
 
-def push_branch(target_branch, pkg_path):
-    switch_to_branch(target_branch, pkg_path)
-    run_cmd(['/usr/bin/git', 'push',], working_directory=pkg_path, wait=True)
+def get_branch_refs(branches, pkg_path, *, remote='origin'):
+    """Return {branch: (local sha, remote-tracking sha)} (None for missing refs)."""
+    shas = _read_refs(pkg_path, [
+        *(f'refs/heads/{branch}' for branch in branches),
+        *(f'refs/remotes/{remote}/{branch}' for branch in branches),
+    ])
+    return {
+        branch: (shas.get(f'refs/heads/{branch}'), shas.get(f'refs/remotes/{remote}/{branch}'))
+        for branch in branches
+    }
+
+def _ssh_command():
+    # one SSH connection per host which is reused by all following pushes and
+    # fetches (also by other packages) as long as it is not idle for too long
+    control_path = _cache_utils.get_cache_dir() / 'ssh-%C'
+    return f'ssh -o ControlMaster=auto -o ControlPath={control_path} -o ControlPersist=120'
+
+class Prefetch:
+    """Run "git fetch" for several repositories in the background so later
+    steps only need a local fast-forward (at most "max_jobs" concurrent
+    fetches). Fetch errors are reported but do not end the script, callers
+    should fall back to "git pull" then."""
+    def __init__(self, pkg_paths, *, remote='origin', max_jobs=4):
+        self._executor = ThreadPoolExecutor(max_workers=max_jobs)
+        self._fetches = {
+            _state_key(pkg_path): self._executor.submit(self._fetch, pkg_path, remote)
+            for pkg_path in pkg_paths if Path(pkg_path).is_dir()
+        }
+
+    @staticmethod
+    def _fetch(pkg_path, remote):
+        return fetch_remote_changes(pkg_path, remote=remote, exit_on_error=False) is not None
+
+    def wait(self, pkg_path):
+        """Return True once the repository was fetched (False if the fetch
+        failed or was never started)."""
+        future = self._fetches.get(_state_key(pkg_path))
+        return (future is not None) and not future.cancelled() and future.result()
+
+    def restrict_to(self, pkg_paths):
+        """Cancel the fetches (which did not start yet) of all other repositories."""
+        keys = {_state_key(pkg_path) for pkg_path in pkg_paths}
+        for key, future in self._fetches.items():
+            if key not in keys:
+                future.cancel()
+
+    def close(self):
+        # fetches which did not start yet are not needed anymore
+        self._executor.shutdown(cancel_futures=True)
+
+def push_branches(branches, pkg_path, *, remote='origin'):
+    """Push several branches with a single "git push" (no checkout needed)."""
+    cmd = ['/usr/bin/git', '-c', f'core.sshCommand={_ssh_command()}', 'push', remote, *branches]
+    run_cmd(cmd, working_directory=pkg_path)
+    invalidate_repo_state(pkg_path)
 
 def pull(remote, pkg_path, *, ff_only):
     assert ff_only
     cmd = ['/usr/bin/git', 'pull', '--ff-only', remote]
-    run_cmd(cmd, working_directory=pkg_path, wait=True)
+    run_cmd(cmd, working_directory=pkg_path)
+    invalidate_repo_state(pkg_path)
 
-def switch_to_branch(target_branch, pkg_path):
-    run_cmd(['/usr/bin/git', 'checkout', target_branch], working_directory=pkg_path, wait=True)
+def merge(source_branch, pkg_path, *, ff_only):
+    assert ff_only
+    cmd = ['/usr/bin/git', 'merge', source_branch, '--ff-only']
+    run_cmd(cmd, working_directory=pkg_path)
+    invalidate_repo_state(pkg_path)
+
+def is_ancestor(ancestor, descendant, pkg_path):
+    """"ancestor" and "descendant" must be commit shas."""
+    try:
+        return _git_batch.is_ancestor(_git_batch.get_cat_file(pkg_path), ancestor, descendant)
+    except _git_batch.MissingObject:
+        # shallow clone: git knows how to deal with the missing history
+        pass
+    cmd = ['/usr/bin/git', 'merge-base', '--is-ancestor', ancestor, descendant]
+    # exit code 1: not an ancestor
+    result = run_cmd(cmd, working_directory=pkg_path, ok_returncodes=(0, 1))
+    return (result.returncode == 0)
+
+def fast_forward_branch(target_branch, source_branch, pkg_path):
+    """Fast-forward "target_branch" to "source_branch" without a checkout.
+
+    Only the currently checked out branch needs a work tree update (via
+    "git merge"), other branches are just moved with "git update-ref".
+    Returns False if the branch was already up to date."""
+    source_sha = branch_sha(source_branch, pkg_path)
+    target_sha = branch_sha(target_branch, pkg_path)
+    if (source_sha is None) or (target_sha is None):
+        missing_branch = source_branch if (source_sha is None) else target_branch
+        raise NotFastForward(f'no branch {missing_branch}')
+    if target_sha == source_sha:
+        return False
+    if not is_ancestor(target_sha, source_sha, pkg_path):
+        raise NotFastForward(f'{target_branch} can not be fast-forwarded to {source_branch}')
+
+    if current_branch(pkg_path) == target_branch:
+        merge(source_branch, pkg_path, ff_only=True)
+        return True
+    # passing the old sha makes the update fail if the branch was changed
+    # concurrently
+    cmd = [
+        '/usr/bin/git', 'update-ref', '-m', f'merge {source_branch}: Fast-forward',
+        f'refs/heads/{target_branch}', source_sha, target_sha,
+    ]
+    run_cmd(cmd, working_directory=pkg_path)
+    invalidate_repo_state(pkg_path)
     return True
 
+def switch_to_branch(target_branch, pkg_path):
+    if current_branch(pkg_path) == target_branch:
+        return True
+    run_cmd(['/usr/bin/git', 'checkout', target_branch], working_directory=pkg_path)
+    invalidate_repo_state(pkg_path)
+    return True
@@ -0,0 +1,102 @@
+
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+import importlib
+from pathlib import Path
+import re
+import tempfile
+
+
+__all__ = [
+    'SignatureCheck',
+    'find_signature_checks',
+    'verify_signatures',
+]
+
+_shell = importlib.import_module('shell-utils')
+
+_gpgverify_regex = re.compile(r'^\s*%\{?gpgverify\}?(.*)$', re.MULTILINE)
+_gpgverify_option_regex = re.compile(r'--(keyring|signature|data)=[\'"]?%\{?SOURCE(\d+)\}?[\'"]?')
+_KEYRING_SUFFIXES = ('.gpg', '.pub', '.key', '.keyring')
+_SIGNATURE_SUFFIXES = ('.asc', '.sig', '.sign')
+
+
+@dataclass
+class SignatureCheck:
+    data_file     : str
+    signature_file: str
+    keyring_file  : str
+    is_valid      : bool = None
+    message       : str  = ''
+
+
+def find_signature_checks(spec_str, source_files):
+    """Return the (data, signature, keyring) combinations to verify.
+
+    "source_files" maps source numbers to filenames. The %{gpgverify} calls
+    in the spec are authoritative, otherwise signatures are paired with the
+    source they are named after."""
+    spec_str = spec_str.replace('\\\n', ' ')
+    checks = []
+    for gpgverify_match in _gpgverify_regex.finditer(spec_str):
+        options = {}
+        for option, source_nr in _gpgverify_option_regex.findall(gpgverify_match.group(1)):
+            options[option] = source_files.get(int(source_nr))
+        if all(options.get(option) for option in ('data', 'signature', 'keyring')):
+            checks.append(SignatureCheck(options['data'], options['signature'], options['keyring']))
+    if checks:
+        return checks
+
+    filenames = set(source_files.values())
+    keyrings = [fn for fn in filenames if fn.endswith(_KEYRING_SUFFIXES)]
+    if len(keyrings) != 1:
+        return []
+    for filename in sorted(filenames):
+        data_file, _, suffix = filename.rpartition('.')
+        if (f'.{suffix}' in _SIGNATURE_SUFFIXES) and (data_file in filenames):
+            checks.append(SignatureCheck(data_file, filename, keyrings[0]))
+    return checks
+
+
+def verify_signature(pkg_path, check):
+    pkg_path = Path(pkg_path)
+    keyring_path = pkg_path / check.keyring_file
+    with tempfile.TemporaryDirectory(prefix='gpgverify-') as gpg_home:
+        # like %{gpgverify}: gpgv needs a binary keyring
+        gpg_keyring = str(Path(gpg_home) / 'keyring.gpg')
+        dearmor_cmd = ['/usr/bin/gpg2', '--homedir', gpg_home, '--dearmor', '--output', gpg_keyring, str(keyring_path)]
+        try:
+            keyring_bytes = keyring_path.read_bytes()
+        except OSError as e:
+            check.is_valid = False
+            check.message = f'unable to read keyring {check.keyring_file}: {e.strerror}'
+            return check
+        if keyring_bytes.startswith(b'-----BEGIN PGP'):
+            dearmor_result = _shell.run_cmd(dearmor_cmd, exit_on_error=False)
+            if dearmor_result.returncode != 0:
+                check.is_valid = False
+                check.message = f'unable to read keyring {check.keyring_file}'
+                return check
+        else:
+            gpg_keyring = str(keyring_path.resolve())
+        gpgv_cmd = [
+            '/usr/bin/gpgv2',
+            '--homedir', gpg_home,
+            '--keyring', gpg_keyring,
+            str(pkg_path / check.signature_file),
+            str(pkg_path / check.data_file),
+        ]
+        gpgv_result = _shell.run_cmd(gpgv_cmd, exit_on_error=False)
+    gpgv_stderr = gpgv_result.stderr.decode('utf8', 'replace')
+    check.is_valid = (gpgv_result.returncode == 0) and ('Good signature' in gpgv_stderr)
+    if check.is_valid:
+        check.message = 'good signature'
+    else:
+        # gpgv explains what went wrong (unknown key, bad signature, …)
+        check.message = 'bad signature: ' + ' '.join(gpgv_stderr.split())
+    return check
+
+
+def verify_signatures(pkg_path, checks, *, max_workers=4):
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(lambda check: verify_signature(pkg_path, check), checks))
@@ -0,0 +1,116 @@
+
+import importlib
+import re
+import xmlrpc.client
+
+
+__all__ = [
+    'BUILD_STATE_COMPLETE',
+    'KOJI_HUB_URL',
+    'TASK_STATE_CLOSED',
+    'TASK_STATE_NAMES',
+    'TASK_FINAL_STATES',
+    'KojiError',
+    'KojiHub',
+    'index_builds',
+]
+
+_trace = importlib.import_module('trace-utils')
+
+KOJI_HUB_URL = 'https://koji.fedoraproject.org/kojihub'
+BUILD_STATE_COMPLETE = 1
+# koji.TASK_STATES
+TASK_STATE_NAMES = {0: 'FREE', 1: 'OPEN', 2: 'CLOSED', 3: 'CANCELED', 4: 'ASSIGNED', 5: 'FAILED'}
+TASK_STATE_CLOSED = 2
+TASK_FINAL_STATES = (2, 3, 5)
+
+_dist_regex = re.compile(r'\.((?:fc|el)\d+)')
+
+
+class KojiError(Exception):
+    pass
+
+
+def _encode_kwargs(kwargs):
+    # koji's hub expects keyword arguments as a trailing struct which is
+    # tagged with "__starstar" (same as koji.ClientSession)
+    return {**kwargs, '__starstar': True}
+
+
+class KojiHub:
+    def __init__(self, url=KOJI_HUB_URL):
+        self.url = url
+        self._proxy = xmlrpc.client.ServerProxy(url, allow_none=True)
+
+    def call(self, method, *args, **kwargs):
+        params = [*args, _encode_kwargs(kwargs)] if kwargs else args
+        try:
+            with _trace.traced(('koji', method, self.url)):
+                return getattr(self._proxy, method)(*params)
+        except xmlrpc.client.Fault as e:
+            raise KojiError(e.faultString)
+
+    def multicall(self, calls):
+        """Execute several (method, args, kwargs) calls in a single request.
+
+        Returns the results in the same order as the calls."""
+        koji_calls = []
+        for method, args, kwargs in calls:
+            params = [*args, _encode_kwargs(kwargs)] if kwargs else list(args)
+            koji_calls.append({'methodName': method, 'params': params})
+        if not koji_calls:
+            return []
+        try:
+            with _trace.traced(('koji', 'multiCall', f'{len(koji_calls)} calls', self.url)):
+                raw_results = self._proxy.multiCall(koji_calls)
+        except xmlrpc.client.Fault as e:
+            raise KojiError(e.faultString)
+
+        results = []
+        for raw_result in raw_results:
+            # each result is either a one-element list or a fault struct
+            if isinstance(raw_result, dict):
+                raise KojiError(raw_result.get('faultString', str(raw_result)))
+            results.append(raw_result[0])
+        return results
+
+    def get_task_states(self, task_ids):
+        """Return {task id: state} for all tasks using a single request."""
+        task_ids = [int(task_id) for task_id in task_ids]
+        task_infos = self.multicall([('getTaskInfo', (task_id, ), {}) for task_id in task_ids])
+        task_states = {}
+        for task_id, task_info in zip(task_ids, task_infos):
+            if task_info is None:
+                raise KojiError(f'unknown task {task_id}')
+            task_states[task_id] = task_info['state']
+        return task_states
+
+    def list_recent_builds(self, pkg_names, *, created_after):
+        pkg_names = tuple(pkg_names)
+        calls = []
+        for pkg_name in pkg_names:
+            list_kwargs = {
+                'pattern': f'{pkg_name}-*',
+                'state': BUILD_STATE_COMPLETE,
+                'createdAfter': created_after.isoformat(),
+                'queryOpts': {'order': '-build_id'},
+            }
+            calls.append(('listBuilds', (), list_kwargs))
+        for pkg_name, pkg_builds in zip(pkg_names, self.multicall(calls)):
+            # the NVR pattern for "python-certbot" also matches all plugins
+            yield from (build for build in pkg_builds if build['name'] == pkg_name)
+
+
+def index_builds(builds):
+    """Map (package name, dist) to the NVR of the newest build.
+
+    "builds" must be ordered newest first (as returned by listBuilds with
+    "-build_id" ordering)."""
+    index = {}
+    for build in builds:
+        match = _dist_regex.search(build['release'])
+        if not match:
+            continue
+        key = (build['name'], match.group(1))
+        index.setdefault(key, build['nvr'])
+    return index
@@ -0,0 +1,146 @@
+
+from collections import deque
+from datetime import datetime
+import importlib
+from pathlib import Path
+import time
+
+
+__all__ = [
+    'BuildLog',
+    'LineWindow',
+    'get_log_dir',
+    'new_log_path',
+]
+
+_cache_utils = importlib.import_module('cache-utils')
+
+DEFAULT_MAX_FILE_SIZE = 16 * 1024**2
+DEFAULT_BACKUP_COUNT = 3
+DEFAULT_TAIL_SIZE = 64 * 1024
+# every build gets its own log files, old ones are deleted eventually
+LOG_MAX_AGE = 14 * 24 * 3600
+
+_pruned_log_dirs = set()
+
+
+def _prune_old_logs(log_dir):
+    if log_dir in _pruned_log_dirs:
+        return
+    _pruned_log_dirs.add(log_dir)
+    for log_path in log_dir.glob('*.log*'):
+        try:
+            if time.time() - log_path.stat().st_mtime > LOG_MAX_AGE:
+                log_path.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def get_log_dir():
+    log_dir = _cache_utils.get_cache_dir() / 'build-logs'
+    log_dir.mkdir(parents=True, exist_ok=True)
+    _prune_old_logs(log_dir)
+    return log_dir
+
+
+def new_log_path(log_dir, name):
+    """Return a log path which does not overwrite the logs of earlier builds,
+    e.g. "certbot-koji-20211012-153012-123456.stdout.log" for
+    name="certbot-koji.stdout"."""
+    base_name, _, suffix = name.rpartition('.')
+    timestamp = datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+    return Path(log_dir) / f'{base_name}-{timestamp}.{suffix}.log'
+
+
+class BuildLog:
+    """Stream output to a rotating log file and keep only its tail in memory.
+
+    Once the log file exceeds "max_file_size" it is renamed to "<name>.1"
+    (older files to "<name>.2" …), at most "backup_count" old files are kept.
+    Memory usage is bounded by "tail_size" regardless of the output size."""
+    def __init__(self, path, *, max_file_size=DEFAULT_MAX_FILE_SIZE, backup_count=DEFAULT_BACKUP_COUNT, tail_size=DEFAULT_TAIL_SIZE):
+        self.path = Path(path)
+        self.max_file_size = max_file_size
+        self.backup_count = backup_count
+        self.tail_size = tail_size
+        self.size = 0
+        self.rotations = 0
+        self._tail = deque()
+        self._tail_bytes = 0
+        self._file_size = 0
+        # logs from a previous build of the same package are stale
+        for backup_path in self._backup_paths():
+            backup_path.unlink(missing_ok=True)
+        self._fp = self.path.open('wb')
+
+    def _backup_paths(self):
+        return [self.path.with_name(f'{self.path.name}.{idx}') for idx in range(1, self.backup_count + 1)]
+
+    def _rotate(self):
+        self._fp.close()
+        backup_paths = self._backup_paths()
+        if backup_paths:
+            for older_path, newer_path in zip(backup_paths[::-1], backup_paths[-2::-1]):
+                if newer_path.exists():
+                    newer_path.replace(older_path)
+            self.path.replace(backup_paths[0])
+        self._fp = self.path.open('wb')
+        self._file_size = 0
+        self.rotations += 1
+
+    def write(self, data):
+        if not data:
+            return
+        if self._fp is None:
+            raise ValueError(f'log {self.path} is already closed')
+        if self._file_size and (self._file_size + len(data) > self.max_file_size):
+            self._rotate()
+        self._fp.write(data)
+        self._file_size += len(data)
+        self.size += len(data)
+
+        self._tail.append(data[-self.tail_size:])
+        self._tail_bytes += len(self._tail[-1])
+        while self._tail_bytes - len(self._tail[0]) >= self.tail_size:
+            self._tail_bytes -= len(self._tail.popleft())
+
+    def describe_files(self):
+        """Where to find the complete output (for messages)."""
+        if not self.rotations:
+            return f'complete log: {self.path}'
+        msg = f'log was rotated, {self.path} contains the end of the output'
+        n_backups = min(self.rotations, self.backup_count)
+        if n_backups == 1:
+            msg += f', earlier output is in {self.path.name}.1'
+        elif n_backups:
+            msg += f', earlier output is in {self.path.name}.1 to .{n_backups}'
+        if self.rotations > self.backup_count:
+            msg += ', the beginning was discarded'
+        return msg
+
+    def tail(self):
+        """Return (at most) the last "tail_size" bytes of the output."""
+        return b''.join(self._tail)[-self.tail_size:]
+
+    def flush(self):
+        if self._fp is not None:
+            self._fp.flush()
+
+    def close(self):
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+
+
+class LineWindow:
+    """The last few lines of a stream, for regexes spanning several lines.
+
+    A match which lies completely within older lines was already found by an
+    earlier search so only the window needs to be searched for each new line
+    (instead of the complete output)."""
+    def __init__(self, *, max_lines=4):
+        self._lines = deque(maxlen=max_lines)
+
+    def search(self, regex, line):
+        self._lines.append(line)
+        return regex.search(b''.join(self._lines))
@@ -6,6 +6,8 @@ Usage:
     merge-branches.py [options] <TARGET_BRANCHES> <pkg>...
     merge-branches.py [options] <TARGET_BRANCHES> --plugins
 
+Options:
+  --jobs=<N>                number of packages to process in parallel [default: 1]
 """
 
 import importlib
@@ -23,7 +25,9 @@ except ImportError:
 _pkg_list = importlib.import_module('pkg-list')
 _git_utils = importlib.import_module('git-utils')
 _git = _git_utils
+_parallel = importlib.import_module('parallel-utils')
 _shell = importlib.import_module('shell-utils')
+PackageResult = _parallel.PackageResult
 sanitize_pkg_names = _shell.sanitize_pkg_names
 
 parse_package_list = _pkg_list.parse_package_list
@@ -34,8 +38,8 @@ SUPPORTED_BRANCHES = ('f34', 'f33', 'f32', 'epel7', 'epel8')
 THIS_DIR = Path(__file__).parent.resolve()
 
 def merge_branch(source_branch, target_branch, pkg_path):
-    _git.switch_to_branch(target_branch, pkg_path)
-    _shell.run_cmd(['/usr/bin/git', 'merge', source_branch, '--ff-only'], working_directory=pkg_path, wait=True)
+    # fast-forward without checking out the target branch
+    return _git.fast_forward_branch(target_branch, source_branch, pkg_path)
 
 def main():
     arguments = docopt(__doc__)
@@ -52,18 +56,27 @@ def main():
         _shell.print_status_output(f'unknown branch {bad_branches}', is_error=True)
         sys.exit(1)
 
-    for pkg_name in pkg_names:
-        _shell.print_in_progress(pkg_name)
+    jobs = _parallel.parse_jobs(arguments['--jobs'])
+
+    def merge_package(pkg_name):
         pkg_path = (THIS_DIR / '..' / pkg_name).resolve()
 
         if _git.has_uncommitted_changes(pkg_path):
             msg = 'uncommitted changes, skipping merge'
-            _shell.print_status_output(pkg_name, is_error=True, msg=msg)
-            continue
+            return PackageResult(pkg_name, is_error=True, msg=msg)
 
+        merged_branches = []
         for target_branch in target_branches:
-            merge_branch(source_branch, target_branch, pkg_path)
-        _shell.print_status_output(pkg_name)
+            try:
+                if merge_branch(source_branch, target_branch, pkg_path):
+                    merged_branches.append(target_branch)
+            except _git.NotFastForward as e:
+                return PackageResult(pkg_name, is_error=True, msg=str(e))
+        if not merged_branches:
+            return PackageResult(pkg_name, msg='up to date')
+        return PackageResult(pkg_name, msg=', '.join(merged_branches))
+
+    _parallel.process_packages(merge_package, pkg_names, jobs=jobs)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,101 @@
+
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+import importlib
+import threading
+
+
+__all__ = [
+    'PackageResult',
+    'Stage',
+    'parse_jobs',
+    'process_packages',
+    'run_pipeline',
+]
+
+_shell = importlib.import_module('shell-utils')
+
+
+@dataclass
+class PackageResult:
+    pkg_name  : str
+    is_error  : bool = False
+    is_warning: bool = False
+    msg       : str  = ''
+
+    def print_status(self):
+        _shell.print_status_output(
+            self.pkg_name,
+            is_error=self.is_error,
+            is_warning=self.is_warning,
+            msg=self.msg,
+        )
+
+
+def parse_jobs(jobs_str):
+    jobs = int(jobs_str or 1)
+    return max(jobs, 1)
+
+
+def process_packages(handler, pkg_names, *, jobs=1, show_progress=True):
+    """Call handler(pkg_name) for every package and print its PackageResult.
+
+    With more than one job the handlers run on a bounded thread pool (the
+    work is dominated by git/network round trips) but results are still
+    printed in list order so the output is stable across runs."""
+    if jobs <= 1:
+        results = []
+        for pkg_name in pkg_names:
+            if show_progress:
+                _shell.print_in_progress(pkg_name)
+            result = handler(pkg_name)
+            result.print_status()
+            results.append(result)
+        return results
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(handler, pkg_name) for pkg_name in pkg_names]
+        results = []
+        for future in futures:
+            result = future.result()
+            result.print_status()
+            results.append(result)
+    return results
+
+
+@dataclass
+class Stage:
+    name           : str
+    # handler(job) returns a PackageResult to finish the job (the last stage
+    # must always return one) or None to pass it on to the next stage
+    handler        : object
+    max_concurrency: int = 1
+
+
+def run_pipeline(stages, jobs):
+    """Run every job through all stages (in order) and print the results.
+
+    Each stage has its own concurrency limit so e.g. network bound stages can
+    run for many packages while only a few CPU heavy stages are active. A job
+    only holds a slot of the stage it is currently in."""
+    stage_slots = [threading.BoundedSemaphore(stage.max_concurrency) for stage in stages]
+
+    def run_job(job):
+        for stage, slots in zip(stages, stage_slots):
+            with slots:
+                result = stage.handler(job)
+            if result is not None:
+                return result
+        raise AssertionError(f'last stage returned no result for {job}')
+
+    if not jobs:
+        return []
+    max_workers = min(len(jobs), sum(stage.max_concurrency for stage in stages))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(run_job, job) for job in jobs]
+        results = []
+        for future in futures:
+            result = future.result()
+            result.print_status()
+            results.append(result)
+    return results
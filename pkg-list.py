@@ -3,16 +3,24 @@ import re
 
 
 __all__ = [
+    'parse_package_dependencies',
     'parse_package_list',
 ]
 
-def parse_package_list(filename):
-    pkg_names = []
+# "<pkg>" or "<pkg>: <dependency> <dependency>…" (build order constraints
+# which can not be derived from the spec files)
+_line_regex = re.compile('^\s*([a-zA-Z\-_0-9]+)(?:\s*:\s*([a-zA-Z\-_0-9\s]*))?$')
+
+def _parse_lines(filename):
     with open(filename, 'r') as fp:
         for line in fp.readlines():
-            match = re.search('^\s*([a-zA-Z\-_0-9]+)$', line)
+            match = _line_regex.search(line)
             if match:
-                pkg_names.append(match.group(1))
-    return pkg_names
+                yield (match.group(1), (match.group(2) or '').split())
 
+def parse_package_list(filename):
+    return [pkg_name for pkg_name, _ in _parse_lines(filename)]
 
+def parse_package_dependencies(filename):
+    """Return {package: set of packages which must be built before}."""
+    return {pkg_name: set(dependencies) for pkg_name, dependencies in _parse_lines(filename)}
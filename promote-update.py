@@ -3,20 +3,43 @@
 from __future__ import print_function
 
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import queue
 
 from bodhi.client.bindings import BodhiClient
 
 STATUSES = ['testing', 'batched', 'stable', 'obsolete', 'unpush', 'revoke']
+ROWS_PER_PAGE = 100
 
 class UpdatePromoter(object):
-    def __init__(self, dry_run=False):
-        self._client = BodhiClient()
-        self._client.init_username()
+    def __init__(self, dry_run=False, max_workers=8):
+        # requests.Session is not thread-safe so each thread borrows a client
+        # of its own. All clients are set up here (in the main thread) because
+        # init_username() might prompt for the username.
+        self._clients = queue.Queue()
+        for _ in range(max_workers):
+            self._clients.put(self._new_client())
         self._dry_run = dry_run
+        self._max_workers = max_workers
         self._log_prefix = ''
         if dry_run:
             self._log_prefix = 'dry run: '
 
+    @staticmethod
+    def _new_client():
+        client = BodhiClient()
+        client.init_username()
+        return client
+
+    @contextmanager
+    def _client(self):
+        client = self._clients.get()
+        try:
+            yield client
+        finally:
+            self._clients.put(client)
+
     def promote_update(self, update, status='stable'):
         print('{}{} - requesting {}'.format(self._log_prefix, update.title, status))
         request_params = {
@@ -24,27 +47,56 @@ class UpdatePromoter(object):
                 'request': status,
             }
         if not self._dry_run:
-            self._client.request(**request_params)
+            with self._client() as client:
+                client.request(**request_params)
 
-    def promote_updates(self, updates, status='stable'):
+    def _eligible_updates(self, updates, status):
+        eligible_updates = []
         for update in updates:
             if status in ['stable', 'batched'] and not update.meets_testing_requirements:
                 print('{}skipping {} - not eligible for {}'.format(self._log_prefix, update.title, status))
                 continue
             if update.request == status:
                 continue
-            self.promote_update(update, status)
+            eligible_updates.append(update)
+        return eligible_updates
+
+    def promote_updates(self, updates, status='stable'):
+        eligible_updates = self._eligible_updates(updates, status)
+        with ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+            futures = [executor.submit(self.promote_update, update, status) for update in eligible_updates]
+            for future in futures:
+                future.result()
+
+    def promote_update_groups(self, update_groups, status='stable'):
+        """Promote groups of updates one after another (e.g. python-acme
+        before everything else), updates within a group are promoted
+        concurrently."""
+        for updates in update_groups:
+            self.promote_updates(updates, status)
 
     def get_updates(self, release, package=None, status='testing'):
+        """Return all matching updates, "release" can also be a list of releases."""
         query_params = {
                 'mine': True,
                 'releases': release,
-                'rows_per_page': 100,
+                'rows_per_page': ROWS_PER_PAGE,
                 'status': status,
             }
         if package:
             query_params['packages'] = package
-        return self._client.query(**query_params).updates
+        with self._client() as client:
+            first_page = client.query(**query_params)
+        updates = list(first_page.updates)
+        pages = range(2, first_page.get('pages', 1) + 1)
+        with ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+            for result in executor.map(lambda page: self._query_page(page, query_params), pages):
+                updates.extend(result.updates)
+        return updates
+
+    def _query_page(self, page, query_params):
+        with self._client() as client:
+            return client.query(page=page, **query_params)
 
 def main():
     parser = argparse.ArgumentParser(description='Promote an update on Bodhi.')
@@ -53,10 +105,11 @@ def main():
     parser.add_argument('-s', '--status', default='stable', metavar='STATUS', choices=STATUSES, help='the status to request (default: stable)')
     parser.add_argument('-o', '--oldstatus', default='testing', metavar='STATUS', choices=STATUSES, help='the current status of the update (default: testing)')
     parser.add_argument('-n', '--dry-run', action='store_true')
+    parser.add_argument('-j', '--jobs', type=int, default=8, help='concurrent requests to Bodhi (default: 8)')
 
     args = parser.parse_args()
 
-    promoter = UpdatePromoter(args.dry_run)
+    promoter = UpdatePromoter(args.dry_run, max_workers=args.jobs)
 
     updates = promoter.get_updates(package=args.package, release=args.release, status=args.oldstatus)
 
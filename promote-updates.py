@@ -13,21 +13,34 @@ def key_names_acme_first(update):
         return '\0' + title
     return title
 
+def group_acme_first(updates):
+    """Split updates into python-acme updates and all others, the first group
+    must be promoted before the second one."""
+    acme_updates = []
+    other_updates = []
+    for update in sorted(updates, key=key_names_acme_first):
+        if update.title.startswith('python-acme'):
+            acme_updates.append(update)
+        else:
+            other_updates.append(update)
+    return [group for group in (acme_updates, other_updates) if group]
+
 def main():
     parser = argparse.ArgumentParser(description='Promote all eligible updates on Bodhi.')
-    parser.add_argument('release', help='the release containing the updates')
+    parser.add_argument('release', nargs='+', help='the release(s) containing the updates')
     parser.add_argument('-s', '--status', default='stable', metavar='STATUS', choices=promote_update.STATUSES, help='the status to request (default: stable)')
     parser.add_argument('-o', '--oldstatus', default='testing', metavar='STATUS', choices=promote_update.STATUSES, help='the current status of the updates (default: testing)')
     parser.add_argument('-n', '--dry-run', action='store_true')
+    parser.add_argument('-j', '--jobs', type=int, default=8, help='concurrent requests to Bodhi (default: 8)')
 
     args = parser.parse_args()
 
-    promoter = promote_update.UpdatePromoter(args.dry_run)
+    promoter = promote_update.UpdatePromoter(args.dry_run, max_workers=args.jobs)
 
+    # a single query for all releases
     updates = promoter.get_updates(release=args.release, status=args.oldstatus)
-    updates.sort(key=key_names_acme_first)
 
-    promoter.promote_updates(updates, args.status)
+    promoter.promote_update_groups(group_acme_first(updates), args.status)
 
 if __name__ == '__main__':
     main()
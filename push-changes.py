@@ -8,6 +8,7 @@ Usage:
 
 Options:
   --branches=<branches>     which branches to push [default: rawhide]
+  --jobs=<N>                number of packages to process in parallel [default: 1]
 """
 
 import importlib
@@ -21,11 +22,11 @@ except ImportError:
     sys.stderr.write('please install python3-docopt\n')
     sys.exit(1)
 _git = importlib.import_module('git-utils')
+_parallel = importlib.import_module('parallel-utils')
 _pkg_list = importlib.import_module('pkg-list')
 _shell_utils = importlib.import_module('shell-utils')
 
-print_status_output = _shell_utils.print_status_output
-print_in_progress = _shell_utils.print_in_progress
+PackageResult = _parallel.PackageResult
 sanitize_pkg_names = _shell_utils.sanitize_pkg_names
 parse_package_list = _pkg_list.parse_package_list
 
@@ -39,19 +40,30 @@ def main():
     if not pkg_names:
         pkg_names = parse_package_list('CERTBOT-PLUGINS.txt')
 
-    for pkg_name in pkg_names:
-        print_in_progress(pkg_name)
+    jobs = _parallel.parse_jobs(arguments['--jobs'])
+
+    def push_package(pkg_name):
         pkg_path = (THIS_DIR / '..' / pkg_name).resolve()
 
         if _git.has_uncommitted_changes(pkg_path):
             error_msg = 'uncommitted changes, skipping package'
-            print_status_output(pkg_name, is_error=True, msg=error_msg)
-            continue
-        for branch in branches:
-            _git.push_branch(branch, pkg_path)
+            return PackageResult(pkg_name, is_error=True, msg=error_msg)
+        branch_refs = _git.get_branch_refs(branches, pkg_path)
+        pushed_branches = []
+        for branch, (branch_sha, remote_sha) in branch_refs.items():
+            if branch_sha is None:
+                return PackageResult(pkg_name, is_error=True, msg=f'no branch {branch}')
+            if branch_sha == remote_sha:
+                continue
+            pushed_branches.append(branch)
+        if not pushed_branches:
+            return PackageResult(pkg_name, is_error=False, msg='nothing to push')
+
+        _git.push_branches(pushed_branches, pkg_path)
+        branch_str = ', '.join(pushed_branches)
+        return PackageResult(pkg_name, is_error=False, msg=branch_str)
 
-        branch_str = ', '.join(branches)
-        print_status_output(pkg_name, is_error=False, msg=branch_str)
+    _parallel.process_packages(push_package, pkg_names, jobs=jobs)
 
 
 if __name__ == '__main__':
@@ -1,20 +1,26 @@
 
+import asyncio
+from dataclasses import dataclass
 import importlib
 import os
 import subprocess
 import sys
-import time
 
 import colorama
 
 
 __all__ = [
+    'CommandResult',
     'display_output',
     'run_cmd',
+    'run_cmd_async',
     'sanitize_pkg_names',
+    'start_coprocess',
+    'start_cmd_async',
 ]
 
 colorama_color = importlib.import_module('colorama-utils').colorama_color
+_trace = importlib.import_module('trace-utils')
 
 def display_output(stdout, stderr, *, header_str=None):
     _c = colorama
@@ -62,33 +68,94 @@ def print_status_output(pkg_name, *, is_error=False, is_warning=False, msg=''):
     sys.stdout.flush()
 
 
-def run_cmd(cmd, *, working_directory=None, dry_run=False, wait=False, exit_on_error=True):
-    if dry_run:
-        print(cmd)
-        return
-    env = {
+@dataclass
+class CommandResult:
+    cmd       : tuple
+    returncode: int
+    stdout    : bytes
+    stderr    : bytes
+
+    def display(self):
+        display_output(self.stdout, self.stderr, header_str=' '.join(self.cmd))
+
+
+def _cmd_env():
+    return {
         'HOME': os.getenv('HOME'),
         'LANG': 'C',
     }
+
+
+def _trace_result(result, *, start, working_directory):
+    _trace.record_command(
+        result.cmd,
+        start=start,
+        cwd=working_directory,
+        returncode=result.returncode,
+        output_bytes=len(result.stdout) + len(result.stderr),
+    )
+
+
+def _handle_cmd_result(result, *, exit_on_error, ok_returncodes=(0,)):
+    if result.returncode not in ok_returncodes:
+        result.display()
+        if exit_on_error:
+            sys.exit(20)
+    return result
+
+
+def start_coprocess(cmd, *, working_directory=None):
+    """Start a long-lived command which answers requests written to its stdin
+    (e.g. "git cat-file --batch"). The caller must read stdout in lockstep
+    with its requests, stderr is discarded."""
+    return subprocess.Popen(
+        cmd,
+        shell=False,
+        env=_cmd_env(),
+        cwd=working_directory,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+    )
+
+
+def run_cmd(cmd, *, working_directory=None, dry_run=False, exit_on_error=True, ok_returncodes=(0,)):
+    if dry_run:
+        print(cmd)
+        return
+    start = _trace.now()
     proc = subprocess.Popen(
         cmd,
         shell=False,
-        env=env,
+        env=_cmd_env(),
         cwd=working_directory,
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
     )
-    if wait:
-        proc.wait()
-    else:
-        time.sleep(0.1)
-        proc.poll()
-    if proc.returncode not in (None, 0):
-        cmd_str = ' '.join(cmd)
-        display_output(proc.stdout.read(), proc.stderr.read(), header_str=cmd_str)
-        if exit_on_error:
-            sys.exit(20)
-    return proc
+    # communicate() reads both pipes concurrently (unlike wait())
+    stdout, stderr = proc.communicate()
+    result = CommandResult(cmd=tuple(cmd), returncode=proc.returncode, stdout=stdout, stderr=stderr)
+    _trace_result(result, start=start, working_directory=working_directory)
+    return _handle_cmd_result(result, exit_on_error=exit_on_error, ok_returncodes=ok_returncodes)
+
+
+async def start_cmd_async(cmd, *, working_directory=None):
+    return await asyncio.create_subprocess_exec(
+        *cmd,
+        env=_cmd_env(),
+        cwd=working_directory,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+
+
+async def run_cmd_async(cmd, *, working_directory=None, exit_on_error=True):
+    start = _trace.now()
+    proc = await start_cmd_async(cmd, working_directory=working_directory)
+    stdout, stderr = await proc.communicate()
+    result = CommandResult(cmd=tuple(cmd), returncode=proc.returncode, stdout=stdout, stderr=stderr)
+    _trace_result(result, start=start, working_directory=working_directory)
+    return _handle_cmd_result(result, exit_on_error=exit_on_error)
 
 
 def sanitize_pkg_names(names):
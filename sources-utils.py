@@ -0,0 +1,219 @@
+
+from concurrent.futures import ThreadPoolExecutor
+import errno
+import hashlib
+import importlib
+import os
+from pathlib import Path
+import re
+import shutil
+import threading
+import time
+import urllib.error
+import urllib.request
+from urllib.parse import urlsplit
+
+
+__all__ = [
+    'SourceCache',
+    'SourceError',
+    'parse_sources_file',
+    'parse_spectool_source_files',
+    'parse_spectool_sources',
+]
+
+_cache_utils = importlib.import_module('cache-utils')
+
+DEFAULT_MAX_CACHE_SIZE = 2 * 1024**3
+_CHUNK_SIZE = 1024 * 1024
+# downloads which are still in progress (maybe in another process) must
+# not be deleted
+_PARTIAL_DOWNLOAD_MAX_AGE = 24 * 3600
+
+_sources_line_regex = re.compile(r'^SHA512 \((.+)\) = ([0-9a-f]{128})$')
+_spectool_line_regex = re.compile(r'^Source(\d*):\s*(\S+)$')
+
+
+class SourceError(Exception):
+    pass
+
+
+def parse_sources_file(pkg_path):
+    """Return {filename: sha512} from the package's "sources" file."""
+    sources_path = Path(pkg_path) / 'sources'
+    if not sources_path.exists():
+        return {}
+    checksums = {}
+    for line in sources_path.read_text().splitlines():
+        match = _sources_line_regex.match(line.strip())
+        if match:
+            checksums[match.group(1)] = match.group(2)
+    return checksums
+
+
+def _iter_spectool_sources(stdout_str):
+    for line in stdout_str.splitlines():
+        match = _spectool_line_regex.match(line.strip())
+        if not match:
+            continue
+        source_nr, source = match.groups()
+        url_parts = urlsplit(source)
+        # "https://host/archive/v1.0.tar.gz#/name-1.0.tar.gz" (as spectool)
+        if url_parts.fragment.startswith('/'):
+            filename = url_parts.fragment[1:]
+        else:
+            filename = url_parts.path.rsplit('/', 1)[-1]
+        yield (int(source_nr or 0), url_parts, filename)
+
+
+def parse_spectool_sources(stdout_str):
+    """Yield (url, filename) for all remote sources in "spectool --list-files"
+    output."""
+    for source_nr, url_parts, filename in _iter_spectool_sources(stdout_str):
+        if url_parts.scheme not in ('http', 'https', 'ftp'):
+            continue
+        yield (url_parts._replace(fragment='').geturl(), filename)
+
+
+def parse_spectool_source_files(stdout_str):
+    """Return {source number: filename} for all (remote and local) sources."""
+    return {source_nr: filename for source_nr, _, filename in _iter_spectool_sources(stdout_str)}
+
+
+def _sha512_of(path):
+    sha512 = hashlib.sha512()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(_CHUNK_SIZE), b''):
+            sha512.update(chunk)
+    return sha512.hexdigest()
+
+
+def _link_or_copy(source, target):
+    if target.exists() or target.is_symlink():
+        target.unlink()
+    try:
+        os.link(source, target)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        shutil.copy2(source, target)
+
+
+class SourceCache:
+    """Content addressed store of upstream tarballs.
+
+    Files are stored by their SHA512 (the checksum used in dist-git "sources"
+    files), the index maps each URL to the checksum of its content. Least
+    recently used files are evicted once the cache exceeds "max_size"."""
+    def __init__(self, *, max_size=DEFAULT_MAX_CACHE_SIZE):
+        self.base_dir = _cache_utils.get_cache_dir() / 'sources'
+        self.objects_dir = self.base_dir / 'objects'
+        self.partial_dir = self.base_dir / 'partial'
+        self.objects_dir.mkdir(parents=True, exist_ok=True)
+        self.partial_dir.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self._index = _cache_utils.JSONFileCache('source-cache.json')
+        self._url_locks = {}
+        self._locks_lock = threading.Lock()
+
+    def _url_lock(self, url):
+        with self._locks_lock:
+            return self._url_locks.setdefault(url, threading.Lock())
+
+    def _object_path(self, sha512):
+        return self.objects_dir / sha512
+
+    def _mark_used(self, sha512):
+        object_info = {'size': self._object_path(sha512).stat().st_size, 'last_used': time.time()}
+        self._index.set(f'object:{sha512}', object_info)
+
+    def lookup(self, url=None, sha512=None):
+        if sha512 is None and url is not None:
+            sha512 = self._index.get(f'url:{url}')
+        if sha512 and self._object_path(sha512).exists():
+            return sha512
+        return None
+
+    def _download(self, url):
+        partial_path = self.partial_dir / hashlib.sha256(url.encode('utf8')).hexdigest()
+        offset = partial_path.stat().st_size if partial_path.exists() else 0
+        request = urllib.request.Request(url)
+        if offset:
+            request.add_header('Range', f'bytes={offset}-')
+        try:
+            with urllib.request.urlopen(request, timeout=60) as response:
+                # servers without range support send the complete file (200)
+                is_resumed = offset and (response.status == 206)
+                with partial_path.open('ab' if is_resumed else 'wb') as fp:
+                    shutil.copyfileobj(response, fp, _CHUNK_SIZE)
+        except urllib.error.HTTPError as e:
+            # 416: the partial file is already complete
+            if not (offset and e.code == 416):
+                raise
+        sha512 = _sha512_of(partial_path)
+        os.replace(partial_path, self._object_path(sha512))
+        self._index.set(f'url:{url}', sha512)
+        return sha512
+
+    def fetch(self, url, *, expected_sha512=None):
+        """Return the SHA512 of the (possibly cached) content behind "url"."""
+        with self._url_lock(url):
+            sha512 = self.lookup(sha512=expected_sha512)
+            if sha512 is None:
+                sha512 = self.lookup(url=url)
+                if expected_sha512 and sha512 and (sha512 != expected_sha512):
+                    # upstream replaced the file behind this URL since it was cached
+                    self._index.delete(f'url:{url}')
+                    sha512 = None
+            if sha512 is None:
+                try:
+                    sha512 = self._download(url)
+                except OSError as e:
+                    raise SourceError(f'error while downloading {url}: {e}')
+            if expected_sha512 and (sha512 != expected_sha512):
+                raise SourceError(f'checksum mismatch for {url}')
+            self._mark_used(sha512)
+        return sha512
+
+    def fetch_into(self, pkg_path, sources, *, max_workers=4):
+        """Fetch all (url, filename) sources in parallel and hard link them
+        into the package directory. Returns the filenames."""
+        checksums = parse_sources_file(pkg_path)
+        def fetch_source(source):
+            url, filename = source
+            sha512 = self.fetch(url, expected_sha512=checksums.get(filename))
+            _link_or_copy(self._object_path(sha512), Path(pkg_path) / filename)
+            return filename
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            filenames = tuple(executor.map(fetch_source, sources))
+        self.evict()
+        return filenames
+
+    def _evict_partial_downloads(self):
+        """Delete aborted downloads which were not resumed for a while, return
+        the size of the remaining ones."""
+        total_size = 0
+        for partial_path in self.partial_dir.iterdir():
+            partial_stat = partial_path.stat()
+            if time.time() - partial_stat.st_mtime > _PARTIAL_DOWNLOAD_MAX_AGE:
+                partial_path.unlink(missing_ok=True)
+            else:
+                total_size += partial_stat.st_size
+        return total_size
+
+    def evict(self):
+        objects = []
+        for object_path in self.objects_dir.iterdir():
+            object_info = self._index.get(f'object:{object_path.name}') or {}
+            last_used = object_info.get('last_used', 0)
+            objects.append((last_used, object_path))
+        total_size = self._evict_partial_downloads()
+        total_size += sum(object_path.stat().st_size for _, object_path in objects)
+        for last_used, object_path in sorted(objects):
+            if total_size <= self.max_size:
+                break
+            total_size -= object_path.stat().st_size
+            # hard links in package directories keep their content
+            object_path.unlink()
+            self._index.delete(f'object:{object_path.name}')
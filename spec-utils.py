@@ -1,17 +1,393 @@
 
+import hashlib
 import importlib
+from pathlib import Path
+import re
 
 _shell = importlib.import_module('shell-utils')
 run_cmd = _shell.run_cmd
 print_status_output = _shell.print_status_output
+_cache_utils = importlib.import_module('cache-utils')
 
+__all__ = [
+    'UnresolvableSpec',
+    'get_version_from_specfile',
+    'parse_package_relations',
+    'parse_spec_version',
+]
 
-def get_version_from_specfile(pkg_path, pkg_name):
+
+class UnresolvableSpec(Exception):
+    pass
+
+# marker for macros whose value we can not determine (e.g. defined inside a
+# conditional we could not evaluate). Using such a macro makes the spec
+# unresolvable.
+_UNKNOWN = object()
+
+# conditional macros which are usually defined by the build host's rpm
+# configuration (not by the spec) so "%{?fedora}" must not expand to ''
+_HOST_MACROS = {
+    'amzn', 'centos', 'dist', 'el6', 'el7', 'el8', 'el9', 'epel', 'fc', 'fedora',
+    'mageia', 'python3_pkgversion', 'rhel', 'suse_version',
+}
+_CONDITIONAL_DIRECTIVES = ('if', 'ifarch', 'ifnarch', 'ifos', 'ifnos', 'elif', 'else', 'endif')
+_section_regex = re.compile(r'^%(prep|build|install|check|files|changelog|description|package)\b')
+_definition_regex = re.compile(r'^%(global|define)\s+(\w+)(\([^)]*\))?\s+(.*)$', re.DOTALL)
+_bcond_regex = re.compile(r'^%bcond_(with|without)\s+(\w+)')
+_tag_regex = re.compile(r'^(Name|Version)\s*:\s*(.*)$', re.IGNORECASE)
+_macro_name_regex = re.compile(r'[A-Za-z_][A-Za-z0-9_]*')
+_build_requires_regex = re.compile(r'^BuildRequires\s*:\s*(.*)$', re.IGNORECASE)
+_name_tag_regex = re.compile(r'^Name\s*:\s*(\S+)', re.IGNORECASE)
+_version_tag_regex = re.compile(r'^(Version|Release)\s*:\s*(.*)$', re.IGNORECASE)
+_package_regex = re.compile(r'^%package\s+(-n\s+)?(\S+)')
+_py3_dist_regex = re.compile(r'%\{py3_dist\s+([^}]+)\}')
+_python3dist_regex = re.compile(r'^python3-(.+)$')
+# dependency tokens are names, version operators or versions ("a >= 1.0")
+_dependency_token_regex = re.compile(r'[^\s,()]+(?:\([^\s()]*\))?')
+_VERSION_OPERATORS = ('<', '<=', '=', '==', '>=', '>')
+_RICH_DEPENDENCY_KEYWORDS = ('and', 'or', 'if', 'else', 'with', 'without', 'unless')
+# system macros commonly used in package names
+_DEFAULT_NAME_MACROS = {'python3_pkgversion': '3'}
+
+
+def _find_closing_brace(text, start):
+    depth = 0
+    for idx in range(start, len(text)):
+        if text[idx] == '{':
+            depth += 1
+        elif text[idx] == '}':
+            depth -= 1
+            if depth == 0:
+                return idx
+    raise UnresolvableSpec(f'unbalanced braces: {text}')
+
+
+def _lookup_macro(name, macros, depth):
+    value = macros.get(name)
+    if value is _UNKNOWN:
+        raise UnresolvableSpec(f'macro %{name} has unknown value')
+    return _expand(value, macros, depth=depth + 1)
+
+
+def _expand_braced(body, macros, depth):
+    if body.startswith(('?', '!?')):
+        negate = body.startswith('!')
+        name, _, alternative = body.lstrip('!?').partition(':')
+        if macros.get(name) is _UNKNOWN:
+            raise UnresolvableSpec(f'macro %{name} has unknown value')
+        is_defined = (name in macros)
+        if not is_defined and name in _HOST_MACROS:
+            raise UnresolvableSpec(f'macro %{name} depends on the build host')
+        if negate:
+            return _expand(alternative, macros, depth=depth + 1) if not is_defined else ''
+        if not is_defined:
+            return ''
+        if alternative:
+            return _expand(alternative, macros, depth=depth + 1)
+        return _lookup_macro(name, macros, depth)
+
+    with_match = re.fullmatch(r'(with|without)\s+(\w+)', body)
+    if with_match:
+        keyword, option = with_match.groups()
+        is_enabled = (f'with_{option}' in macros)
+        return '1' if (is_enabled == (keyword == 'with')) else '0'
+    if not _macro_name_regex.fullmatch(body):
+        # %{lua:...}, %{expand:...}, %{sub ...}: needs real rpm
+        raise UnresolvableSpec(f'unsupported macro %{{{body}}}')
+    if body not in macros:
+        raise UnresolvableSpec(f'undefined macro %{body}')
+    return _lookup_macro(body, macros, depth)
+
+
+def _expand(text, macros, *, depth=0):
+    if depth > 30:
+        raise UnresolvableSpec('macro recursion too deep')
+    parts = []
+    idx = 0
+    while idx < len(text):
+        char = text[idx]
+        if char != '%':
+            parts.append(char)
+            idx += 1
+            continue
+        next_char = text[idx+1:idx+2]
+        if next_char == '%':
+            parts.append('%')
+            idx += 2
+        elif next_char == '{':
+            end = _find_closing_brace(text, idx + 1)
+            parts.append(_expand_braced(text[idx+2:end], macros, depth))
+            idx = end + 1
+        elif next_char in ('(', '['):
+            raise UnresolvableSpec(f'shell/expression expansion in {text}')
+        else:
+            match = _macro_name_regex.match(text, idx + 1)
+            if not match:
+                parts.append(char)
+                idx += 1
+                continue
+            name = match.group(0)
+            if name not in macros:
+                raise UnresolvableSpec(f'undefined macro %{name}')
+            parts.append(_lookup_macro(name, macros, depth))
+            idx = match.end()
+    return ''.join(parts)
+
+
+def _evaluate_simple_condition(expr):
+    expr = expr.strip()
+    negate = expr.startswith('!')
+    if negate:
+        expr = expr[1:].strip()
+    int_match = re.fullmatch(r'-?\d+', expr)
+    if int_match:
+        result = (int(expr) != 0)
+        return (not result) if negate else result
+    if negate:
+        return None
+    cmp_match = re.fullmatch(r'(-?\d+|"[^"]*")\s*(==|!=|<=|>=|<|>)\s*(-?\d+|"[^"]*")', expr)
+    if not cmp_match:
+        return None
+    left, op, right = cmp_match.groups()
+    is_str = left.startswith('"')
+    if is_str != right.startswith('"'):
+        return None
+    left, right = (left.strip('"'), right.strip('"')) if is_str else (int(left), int(right))
+    return {
+        '==': left == right, '!=': left != right,
+        '<=': left <= right, '>=': left >= right,
+        '<' : left < right,  '>' : left > right,
+    }[op]
+
+
+def _evaluate_condition(expr, macros):
+    """Evaluate a "%if" expression: returns True/False or None if unknown."""
+    try:
+        expanded = _expand(expr, macros)
+    except UnresolvableSpec:
+        return None
+    or_values = []
+    for or_term in expanded.split('||'):
+        and_values = [_evaluate_simple_condition(term) for term in or_term.split('&&')]
+        if False in and_values:
+            or_values.append(False)
+        elif None in and_values:
+            or_values.append(None)
+        else:
+            or_values.append(True)
+    if True in or_values:
+        return True
+    if None in or_values:
+        return None
+    return False
+
+
+def _logical_lines(spec_str):
+    line_buffer = ''
+    for line in spec_str.splitlines():
+        if line.endswith('\\'):
+            line_buffer += line[:-1] + '\n'
+            continue
+        yield line_buffer + line
+        line_buffer = ''
+    if line_buffer:
+        yield line_buffer
+
+
+def parse_spec_version(spec_str):
+    """Return the version of the main package without calling rpmspec.
+
+    Supports %global/%define, %bcond_with(out), the usual conditional macro
+    forms and simple %if/%elif/%else conditionals. Raises UnresolvableSpec if
+    the version can not be determined reliably."""
+    macros = {}
+    # each entry: [state of current branch, was any branch taken]
+    # (True/False or None if the condition could not be evaluated)
+    conditionals = []
+
+    for line in _logical_lines(spec_str):
+        stripped = line.strip()
+        directive_match = re.match(r'^%(\w+)\b\s*(.*)$', stripped, re.DOTALL)
+        directive = directive_match.group(1) if directive_match else None
+        if directive in _CONDITIONAL_DIRECTIVES:
+            expr = directive_match.group(2)
+            if directive.startswith('if'):
+                state = _evaluate_condition(expr, macros) if (directive == 'if') else None
+                conditionals.append([state, state])
+            elif not conditionals:
+                raise UnresolvableSpec(f'unexpected %{directive}')
+            elif directive == 'elif':
+                entry = conditionals[-1]
+                if entry[1] is True:
+                    entry[0] = False
+                else:
+                    state = _evaluate_condition(expr, macros)
+                    entry[0] = state if (entry[1] is False) else (None if state is not False else False)
+                    entry[1] = state if (entry[1] is False) else entry[1]
+            elif directive == 'else':
+                entry = conditionals[-1]
+                entry[0] = (not entry[1]) if (entry[1] is not None) else None
+            else:
+                conditionals.pop()
+            continue
+
+        states = [entry[0] for entry in conditionals]
+        if False in states:
+            continue
+        is_known = (None not in states)
+
+        if _section_regex.match(stripped):
+            break
+        definition_match = _definition_regex.match(stripped)
+        if definition_match:
+            keyword, name, params, body = definition_match.groups()
+            if params or not is_known:
+                macros[name] = _UNKNOWN
+            elif keyword == 'global':
+                try:
+                    macros[name] = _expand(body.strip(), macros)
+                except UnresolvableSpec:
+                    macros[name] = _UNKNOWN
+            else:
+                macros[name] = body.strip()
+            continue
+        bcond_match = _bcond_regex.match(stripped)
+        if bcond_match:
+            default, option = bcond_match.groups()
+            if not is_known:
+                macros[f'with_{option}'] = _UNKNOWN
+            elif default == 'without':
+                macros[f'with_{option}'] = '1'
+            continue
+        tag_match = _tag_regex.match(stripped)
+        if tag_match:
+            tag, value = tag_match.groups()
+            if not is_known:
+                raise UnresolvableSpec(f'{tag} tag in unknown conditional branch')
+            value = _expand(value.strip(), macros)
+            macros[tag.lower()] = value
+            if tag.lower() == 'version':
+                if not value or ('%' in value):
+                    raise UnresolvableSpec(f'bad version {value!r}')
+                return value
+    raise UnresolvableSpec('no Version tag found')
+
+
+def _dependency_names(value):
+    names = []
+    skip_next = False
+    for token in _dependency_token_regex.findall(value):
+        if skip_next:
+            skip_next = False
+        elif token in _VERSION_OPERATORS:
+            # the next token is the version
+            skip_next = True
+        elif token not in _RICH_DEPENDENCY_KEYWORDS:
+            names.append(token)
+    return names
+
+
+def _build_requires_names(value, macros):
+    try:
+        return _dependency_names(_expand(value, macros))
+    except UnresolvableSpec:
+        pass
+    # only the names matter so an unresolvable macro elsewhere (e.g. in a
+    # version) must not hide them
+    names = []
+    for token in _dependency_names(value):
+        try:
+            names.extend(_dependency_names(_expand(token, macros)))
+        except UnresolvableSpec:
+            continue
+    return names
+
+
+def parse_package_relations(spec_str):
+    """Return (provided package names, BuildRequires names) of a spec.
+
+    Unlike parse_spec_version() this is lenient: BuildRequires from all
+    conditional branches are returned and values containing macros which can
+    not be expanded are skipped (names are kept if the macro is only used
+    in the version). Provided names include the python3dist()
+    names of python3-* subpackages."""
+    macros = dict(_DEFAULT_NAME_MACROS)
+    main_name = None
+    provides = set()
+    build_requires = set()
+    for line in _logical_lines(spec_str):
+        stripped = line.strip()
+        definition_match = _definition_regex.match(stripped)
+        if definition_match:
+            keyword, name, params, body = definition_match.groups()
+            if not params:
+                macros[name] = body.strip()
+            continue
+        stripped = _py3_dist_regex.sub(lambda m: ' '.join(f'python3dist({name})' for name in m.group(1).split()), stripped)
+        try:
+            name_match = _name_tag_regex.match(stripped)
+            package_match = _package_regex.match(stripped)
+            build_requires_match = _build_requires_regex.match(stripped)
+            version_match = _version_tag_regex.match(stripped)
+            if name_match and (main_name is None):
+                main_name = _expand(name_match.group(1), macros)
+                macros['name'] = main_name
+                provides.add(main_name)
+            elif package_match and (main_name is not None):
+                is_full_name, name = package_match.groups()
+                name = _expand(name, macros)
+                provides.add(name if is_full_name else f'{main_name}-{name}')
+            elif version_match and (version_match.group(1).lower() not in macros):
+                tag, value = version_match.groups()
+                # stays unknown if the value can not be expanded
+                macros[tag.lower()] = _UNKNOWN
+                macros[tag.lower()] = _expand(value.strip(), macros)
+            elif build_requires_match:
+                build_requires.update(_build_requires_names(build_requires_match.group(1), macros))
+        except UnresolvableSpec:
+            continue
+
+    for name in tuple(provides):
+        python3dist_match = _python3dist_regex.match(name)
+        if python3dist_match:
+            provides.add(f'python3dist({python3dist_match.group(1)})')
+    return provides, build_requires
+
+
+_version_cache = _cache_utils.JSONFileCache('spec-versions.json')
+
+def _get_version_from_rpmspec(pkg_path, pkg_name):
     rpmspec_cmd = ['/usr/bin/rpmspec', '-q', '--srpm', '--qf', '%{version}', f'{pkg_name}.spec']
-    rpmspec_proc = run_cmd(rpmspec_cmd, working_directory=pkg_path, wait=True, exit_on_error=False)
+    rpmspec_proc = run_cmd(rpmspec_cmd, working_directory=pkg_path, exit_on_error=False)
     if rpmspec_proc.returncode != 0:
         error = 'error while retrieving previous version from spec file'
         print_status_output(pkg_name, is_error=True, msg=error)
         return
-    old_version = rpmspec_proc.stdout.read().decode('utf8').strip()
+    old_version = rpmspec_proc.stdout.decode('utf8').strip()
     return old_version
+
+
+def get_version_from_specfile(pkg_path, pkg_name):
+    spec_path = (Path(pkg_path) / f'{pkg_name}.spec').resolve()
+    try:
+        spec_mtime = spec_path.stat().st_mtime_ns
+        spec_bytes = spec_path.read_bytes()
+    except OSError:
+        # let rpmspec report the error
+        return _get_version_from_rpmspec(pkg_path, pkg_name)
+
+    cache_key = str(spec_path)
+    spec_hash = hashlib.sha256(spec_bytes).hexdigest()
+    cached = _version_cache.get(cache_key)
+    if cached and (cached['mtime'] == spec_mtime) and (cached['sha256'] == spec_hash):
+        return cached['version']
+
+    try:
+        version = parse_spec_version(spec_bytes.decode('utf8'))
+    except (UnresolvableSpec, UnicodeDecodeError):
+        version = _get_version_from_rpmspec(pkg_path, pkg_name)
+    if version is not None:
+        cache_entry = {'mtime': spec_mtime, 'sha256': spec_hash, 'version': version}
+        _version_cache.set(cache_key, cache_entry)
+    return version
@@ -0,0 +1,92 @@
+
+from dataclasses import dataclass, fields
+import importlib
+from pathlib import Path
+import sqlite3
+import threading
+import time
+
+
+__all__ = [
+    'PackageState',
+    'StateStore',
+    'get_state_store',
+]
+
+_cache_utils = importlib.import_module('cache-utils')
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS package_state (
+    pkg_name   TEXT NOT NULL,
+    branch     TEXT NOT NULL,
+    built_sha  TEXT,
+    build_nvr  TEXT,
+    bug_id     TEXT,
+    updated_at REAL,
+    PRIMARY KEY (pkg_name, branch)
+)
+'''
+
+
+@dataclass
+class PackageState:
+    pkg_name  : str
+    branch    : str
+    built_sha : str   = None   # commit of the last successful koji build
+    build_nvr : str   = None
+    bug_id    : str   = None   # last release bug handled by update-certbot-packages
+    updated_at: float = None
+
+
+_COLUMNS = tuple(field.name for field in fields(PackageState))
+
+
+class StateStore:
+    """Package state shared between runs and scripts (one row per package
+    and branch). Safe to use from worker threads."""
+    def __init__(self, path=None):
+        self.path = Path(path) if path else (_cache_utils.get_cache_dir() / 'package-state.sqlite3')
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        with self._lock, self._db:
+            # WAL: other scripts can read while one is writing
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute(_SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def get(self, pkg_name, branch):
+        query = f'SELECT {", ".join(_COLUMNS)} FROM package_state WHERE pkg_name = ? AND branch = ?'
+        with self._lock:
+            row = self._db.execute(query, (pkg_name, branch)).fetchone()
+        if row is None:
+            return PackageState(pkg_name, branch)
+        return PackageState(*row)
+
+    def update(self, pkg_name, branch, **values):
+        unknown_columns = set(values).difference(_COLUMNS)
+        if unknown_columns:
+            raise ValueError('unknown state field(s) ' + ', '.join(sorted(unknown_columns)))
+        values['updated_at'] = time.time()
+        columns = ', '.join(values)
+        placeholders = ', '.join('?' for _ in values)
+        assignments = ', '.join(f'{column} = excluded.{column}' for column in values)
+        statement = (
+            f'INSERT INTO package_state (pkg_name, branch, {columns}) VALUES (?, ?, {placeholders}) '
+            f'ON CONFLICT (pkg_name, branch) DO UPDATE SET {assignments}'
+        )
+        with self._lock, self._db:
+            self._db.execute(statement, (pkg_name, branch, *values.values()))
+
+
+_state_store = None
+_state_store_lock = threading.Lock()
+
+def get_state_store():
+    global _state_store
+    with _state_store_lock:
+        if _state_store is None:
+            _state_store = StateStore()
+        return _state_store
@@ -0,0 +1,67 @@
+import importlib
+from pathlib import Path
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+_dependency_utils = importlib.import_module('dependency-utils')
+
+
+SPECS = {
+    'python-acme': '''
+Name:           python-acme
+Version:        1.20.0
+Release:        1%{?dist}
+
+%package -n     python3-acme
+''',
+    'python-certbot': '''
+%global pypi_name certbot
+Name:           python-%{pypi_name}
+Version:        1.20.0
+Release:        1%{?dist}
+BuildRequires:  python3-acme >= %{version}
+
+%package -n     python3-%{pypi_name}
+''',
+    'python-certbot-dns-ovh': '''
+Name:           python-certbot-dns-ovh
+Version:        1.20.0
+Release:        1%{?dist}
+BuildRequires:  python3dist(certbot) >= %{version}
+BuildRequires:  python3dist(acme) >= %{unknown_macro}
+BuildRequires:  %{unknown_macro}-devel
+
+%package -n     python3-certbot-dns-ovh
+''',
+}
+
+
+class DependencyUtilsTest(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.pkg_paths = []
+        for pkg_name, spec_str in SPECS.items():
+            pkg_path = Path(tmp_dir.name) / pkg_name
+            pkg_path.mkdir()
+            (pkg_path / f'{pkg_name}.spec').write_text(spec_str)
+            self.pkg_paths.append(pkg_path)
+
+    def test_read_build_dependencies_with_version_macros(self):
+        self.assertEqual(_dependency_utils.read_build_dependencies(self.pkg_paths), {
+            'python-acme': set(),
+            'python-certbot': {'python-acme'},
+            'python-certbot-dns-ovh': {'python-acme', 'python-certbot'},
+        })
+
+    def test_build_layers(self):
+        dependencies = _dependency_utils.read_build_dependencies(self.pkg_paths)
+        self.assertEqual(_dependency_utils.build_layers(dependencies), [
+            ['python-acme'], ['python-certbot'], ['python-certbot-dns-ovh'],
+        ])
+
+
+if __name__ == '__main__':
+    unittest.main()
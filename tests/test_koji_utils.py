@@ -0,0 +1,98 @@
+from datetime import datetime
+from fnmatch import fnmatchcase
+import importlib
+from pathlib import Path
+import sys
+import threading
+import unittest
+from xmlrpc.server import SimpleXMLRPCRequestHandler, SimpleXMLRPCServer
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+_koji = importlib.import_module('koji-utils')
+
+
+BUILDS = [
+    {'build_id': 5, 'name': 'python-certbot', 'release': '1.fc35', 'nvr': 'python-certbot-1.20.0-1.fc35'},
+    {'build_id': 4, 'name': 'python-certbot-dns-ovh', 'release': '1.fc35', 'nvr': 'python-certbot-dns-ovh-1.20.0-1.fc35'},
+    {'build_id': 3, 'name': 'python-certbot', 'release': '1.el8', 'nvr': 'python-certbot-1.19.0-1.el8'},
+    {'build_id': 2, 'name': 'python-certbot', 'release': '1.fc35', 'nvr': 'python-certbot-1.19.0-1.fc35'},
+    {'build_id': 1, 'name': 'python-certbot', 'release': '1', 'nvr': 'python-certbot-1.18.0-1'},
+]
+
+
+class FakeKojiHub:
+    """Answers multiCall() requests like the koji hub (for the methods used
+    by koji-utils)."""
+    def __init__(self):
+        self.requests = []
+
+    def _listBuilds(self, *, pattern, state, createdAfter, queryOpts):
+        assert queryOpts == {'order': '-build_id'}
+        return [build for build in BUILDS if fnmatchcase(build['nvr'], pattern)]
+
+    def _getTaskInfo(self, task_id):
+        return {'id': task_id, 'state': _koji.TASK_STATE_CLOSED} if (task_id == 42) else None
+
+    def _call(self, method, params):
+        kwargs = {}
+        if params and isinstance(params[-1], dict) and params[-1].pop('__starstar', False):
+            kwargs = params.pop()
+        return getattr(self, f'_{method}')(*params, **kwargs)
+
+    def multiCall(self, calls):
+        self.requests.append([call['methodName'] for call in calls])
+        results = []
+        for call in calls:
+            try:
+                results.append([self._call(call['methodName'], call['params'])])
+            except Exception as e:
+                results.append({'faultCode': 1000, 'faultString': f'{type(e).__name__}: {e}'})
+        return results
+
+
+class _KojiRequestHandler(SimpleXMLRPCRequestHandler):
+    rpc_paths = ('/kojihub', )
+
+    def log_message(self, format, *args):
+        pass
+
+
+class KojiUtilsTest(unittest.TestCase):
+    def setUp(self):
+        self.fake_hub = FakeKojiHub()
+        server = SimpleXMLRPCServer(('127.0.0.1', 0), requestHandler=_KojiRequestHandler, allow_none=True, logRequests=False)
+        server.register_function(self.fake_hub.multiCall, 'multiCall')
+        threading.Thread(target=server.serve_forever, kwargs={'poll_interval': 0.05}, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        host, port = server.server_address
+        self.hub = _koji.KojiHub(f'http://{host}:{port}/kojihub')
+
+    def test_list_recent_builds_uses_one_request(self):
+        builds = list(self.hub.list_recent_builds(['python-certbot', 'python-certbot-dns-ovh'], created_after=datetime(2021, 1, 1)))
+        self.assertEqual(self.fake_hub.requests, [['listBuilds', 'listBuilds']])
+        self.assertEqual([build['build_id'] for build in builds], [5, 3, 2, 1, 4])
+
+    def test_list_recent_builds_only_returns_the_requested_package(self):
+        builds = list(self.hub.list_recent_builds(['python-certbot'], created_after=datetime(2021, 1, 1)))
+        self.assertEqual({build['name'] for build in builds}, {'python-certbot'})
+
+    def test_index_builds_keeps_newest_build_per_dist(self):
+        builds = self.hub.list_recent_builds(['python-certbot'], created_after=datetime(2021, 1, 1))
+        self.assertEqual(_koji.index_builds(builds), {
+            ('python-certbot', 'fc35'): 'python-certbot-1.20.0-1.fc35',
+            ('python-certbot', 'el8'): 'python-certbot-1.19.0-1.el8',
+        })
+
+    def test_get_task_states(self):
+        self.assertEqual(self.hub.get_task_states(['42']), {42: _koji.TASK_STATE_CLOSED})
+        with self.assertRaises(_koji.KojiError):
+            self.hub.get_task_states([42, 43])
+
+    def test_fault_is_raised_as_koji_error(self):
+        with self.assertRaisesRegex(_koji.KojiError, 'AttributeError'):
+            self.hub.multicall([('unknownMethod', (), {})])
+
+
+if __name__ == '__main__':
+    unittest.main()
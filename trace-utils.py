@@ -0,0 +1,160 @@
+
+import atexit
+from collections import defaultdict
+from contextlib import contextmanager
+from dataclasses import dataclass
+import json
+import os
+from pathlib import Path
+import threading
+import time
+
+
+__all__ = [
+    'CommandRecord',
+    'enable_tracing',
+    'now',
+    'print_summary',
+    'record_command',
+    'register_exit_handler',
+    'traced',
+    'write_chrome_trace',
+]
+
+_start_time = time.perf_counter()
+# nothing is recorded unless enable_tracing() was called
+_is_enabled = False
+_trace_path = None
+_exit_handlers = []
+_records = []
+_records_lock = threading.Lock()
+
+
+@dataclass
+class CommandRecord:
+    argv        : tuple
+    cwd         : str
+    package     : str
+    start       : float   # seconds since the script was started
+    duration    : float
+    returncode  : int = None
+    output_bytes: int = 0
+
+    @property
+    def tool(self):
+        return Path(self.argv[0]).name if self.argv else '?'
+
+
+def now():
+    return time.perf_counter() - _start_time
+
+
+def record_command(argv, *, start, cwd=None, package=None, returncode=None, output_bytes=0):
+    if not _is_enabled:
+        return None
+    if (package is None) and cwd:
+        package = Path(cwd).resolve().name
+    record = CommandRecord(
+        argv=tuple(str(arg) for arg in argv),
+        cwd=str(cwd) if cwd else None,
+        package=package,
+        start=start,
+        duration=now() - start,
+        returncode=returncode,
+        output_bytes=output_bytes,
+    )
+    with _records_lock:
+        _records.append(record)
+    return record
+
+
+@contextmanager
+def traced(argv, *, cwd=None, package=None):
+    """Record the duration of the block (e.g. an HTTP request) like a command.
+
+    The block can set "returncode" and "output_bytes" in the yielded dict."""
+    start = now()
+    info = {'returncode': None, 'output_bytes': 0}
+    try:
+        yield info
+    finally:
+        record_command(argv, start=start, cwd=cwd, package=package, **info)
+
+
+def write_chrome_trace(trace_path):
+    # one row per package in the trace viewer
+    lanes = {}
+    events = []
+    with _records_lock:
+        records = list(_records)
+    for record in records:
+        lane = lanes.setdefault(record.package, len(lanes) + 1)
+        events.append({
+            'name': record.tool,
+            'cat' : 'command',
+            'ph'  : 'X',
+            'ts'  : round(record.start * 1e6),
+            'dur' : round(record.duration * 1e6),
+            'pid' : os.getpid(),
+            'tid' : lane,
+            'args': {
+                'argv': ' '.join(record.argv),
+                'cwd': record.cwd,
+                'returncode': record.returncode,
+                'output_bytes': record.output_bytes,
+            },
+        })
+    for package, lane in lanes.items():
+        events.append({
+            'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': lane,
+            'args': {'name': package or '(no package)'},
+        })
+    with open(trace_path, 'w') as fp:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, fp)
+
+
+def print_summary(*, limit=10):
+    with _records_lock:
+        records = list(_records)
+    if not records:
+        return
+    print('\nslowest commands:')
+    for record in sorted(records, key=lambda r: r.duration, reverse=True)[:limit]:
+        package_str = f'  [{record.package}]' if record.package else ''
+        cmd_str = ' '.join(record.argv)
+        if len(cmd_str) > 70:
+            cmd_str = cmd_str[:69] + '…'
+        print(f'  {record.duration:8.2f}s  {cmd_str}{package_str}')
+
+    tool_durations = defaultdict(float)
+    tool_calls = defaultdict(int)
+    for record in records:
+        tool_durations[record.tool] += record.duration
+        tool_calls[record.tool] += 1
+    print('time per tool:')
+    for tool, duration in sorted(tool_durations.items(), key=lambda item: item[1], reverse=True):
+        print(f'  {tool:<12} {duration:8.2f}s  ({tool_calls[tool]} calls)')
+
+
+def register_exit_handler(func):
+    """Call "func" when the script exits but before the trace is written
+    (so commands it finishes are still recorded)."""
+    _exit_handlers.append(func)
+    return func
+
+@atexit.register
+def _finish_tracing():
+    for func in reversed(_exit_handlers):
+        func()
+    if not _is_enabled:
+        return
+    if _trace_path:
+        write_chrome_trace(_trace_path)
+    print_summary()
+
+def enable_tracing(trace_path):
+    """Write a Chrome trace (chrome://tracing, Perfetto) and print a timing
+    summary when the script exits."""
+    global _is_enabled, _trace_path
+    _is_enabled = True
+    _trace_path = trace_path
@@ -8,17 +8,32 @@ Usage:
 
 Options:
    --branch=<branch>            which branch to build [default: master]
+   --side-tag=<TAG>             build into a Koji side tag (--build only)
+   --only-changed               skip packages already built from their current HEAD (--build only)
+   --detach                     submit koji builds with --nowait and poll all tasks together
+   --poll-interval=<SEC>        seconds between polls of detached koji tasks [default: 30]
+   --koji-hub=<URL>             koji hub to poll [default: https://koji.fedoraproject.org/kojihub]
+   --jobs=<N>                   concurrent mock builds [default: 1]
+   --mock-cpus=<N>              CPU cores per mock build (default: all cores divided by --jobs)
+   --mock-memory-estimate=<MB>  expected peak memory of one mock build, only used
+                                to limit concurrent builds (not enforced) [default: 4096]
+   --mock-root=<ROOT>           mock config (default: derived from --branch)
+   --trace=<FILE>               write a Chrome trace of all commands and print a timing summary
 
 """
 
+import asyncio
 from dataclasses import dataclass
 import importlib
-from pathlib import Path
 import os
+from pathlib import Path
+import platform
 import re
-import subprocess
+import shutil
 import sys
+import tempfile
 import time
+import xmlrpc.client
 
 try:
     from docopt import docopt
@@ -29,40 +44,164 @@ except ImportError:
 
 _git = importlib.import_module('git-utils')
 _shell_utils = importlib.import_module('shell-utils')
+_trace = importlib.import_module('trace-utils')
 display_output = _shell_utils.display_output
 print_status_output = _shell_utils.print_status_output
-run_cmd = _shell_utils.run_cmd
+run_cmd_async = _shell_utils.run_cmd_async
+start_cmd_async = _shell_utils.start_cmd_async
 sanitize_pkg_names = _shell_utils.sanitize_pkg_names
 
+_log_utils = importlib.import_module('log-utils')
+BuildLog = _log_utils.BuildLog
+LineWindow = _log_utils.LineWindow
+
 _pkg_list = importlib.import_module('pkg-list')
 parse_package_list = _pkg_list.parse_package_list
+parse_package_dependencies = _pkg_list.parse_package_dependencies
+
+_koji = importlib.import_module('koji-utils')
+KojiError = _koji.KojiError
+KojiHub = _koji.KojiHub
+TASK_FINAL_STATES = _koji.TASK_FINAL_STATES
+TASK_STATE_CLOSED = _koji.TASK_STATE_CLOSED
+
+_cache_utils = importlib.import_module('cache-utils')
+_state = importlib.import_module('state-utils')
+_mock_durations = _cache_utils.JSONFileCache('mock-durations.json')
+
+_dependency_utils = importlib.import_module('dependency-utils')
+build_layers = _dependency_utils.build_layers
+DependencyCycle = _dependency_utils.DependencyCycle
+read_build_dependencies = _dependency_utils.read_build_dependencies
 
+_READ_SIZE = 64 * 1024
+# fedpkg build: "Building certbot-1.20.0-1.fc36 for rawhide"
+_building_regex = re.compile(b'^Building (\S+) for (\S+)\n')
 
-def create_srpm(pkg_path):
+
+async def create_srpm(pkg_path):
     cmd = ['/usr/bin/fedpkg', 'srpm']
-    proc = run_cmd(cmd, working_directory=pkg_path)
-    match = re.search(b'Wrote:\s*(.+?)\n', proc.stdout.read())
+    result = await run_cmd_async(cmd, working_directory=pkg_path)
+    match = re.search(b'Wrote:\s*(.+?)\n', result.stdout)
     if not match:
-        display_output(proc.stdout.read(), proc.stderr.read())
+        display_output(result.stdout, result.stderr)
+        sys.exit(20)
     byte_path = match.group(1)
     # Path() does not accept bytes
     path_src_rpm = Path(byte_path.decode('UTF8'))
     return path_src_rpm
 
 
-@dataclass
+class SrpmBuilder:
+    """Create SRPMs concurrently (at most one "fedpkg srpm" per CPU core) in a
+    temporary directory.
+
+    Submitters await get() so each build is submitted as soon as its own SRPM
+    is ready while the remaining SRPMs are still being created. Leaving the
+    "async with" block stops all pending SRPM builds and removes the
+    directory (also if an exception occurred)."""
+    def __init__(self, *, max_jobs=None):
+        self._semaphore = asyncio.Semaphore(max_jobs or os.cpu_count() or 1)
+        self._tasks = {}
+        self._tmp_dir = None
+        self.srpm_dir = None
+
+    async def __aenter__(self):
+        self._tmp_dir = tempfile.TemporaryDirectory(prefix='trigger-builds-')
+        self.srpm_dir = Path(self._tmp_dir.name)
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        for task in self._tasks.values():
+            task.cancel()
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+        self._tmp_dir.cleanup()
+
+    def _task(self, pkg_path):
+        if pkg_path not in self._tasks:
+            self._tasks[pkg_path] = asyncio.ensure_future(self._create(pkg_path))
+        return self._tasks[pkg_path]
+
+    async def _create(self, pkg_path):
+        async with self._semaphore:
+            path_src_rpm = await create_srpm(pkg_path)
+        srpm_path = self.srpm_dir / path_src_rpm.name
+        await asyncio.to_thread(shutil.move, path_src_rpm, srpm_path)
+        return srpm_path
+
+    def prefetch(self, pkg_paths):
+        for pkg_path in pkg_paths:
+            self._task(pkg_path)
+
+    async def get(self, pkg_path):
+        return await self._task(pkg_path)
+
+
+# eq=False: builds are compared by identity (as_completed() needs hashable awaitables)
+@dataclass(eq=False)
 class BuildProcess:
     pkg_name: str
-    proc    : subprocess.Popen
+    proc    : asyncio.subprocess.Process
     type_   : str
-    stdout  : bytes = b''
-    stderr  : bytes = b''
-    _rc     : int   = None
     url     : str   = None
     task_id : int   = None
+    cmd     : tuple = ()
+    start   : float = None
+    nvr     : str   = None
+    target  : str   = None
+    # detached koji builds: fedpkg only submits the task, the build is done
+    # once the koji task reached a final state
+    detached  : bool = False
+    task_state: int  = None
+    log_dir : Path  = None
+    stdout_log: object = None   # log-utils.BuildLog
+    stderr_log: object = None
+    _stderr_reader: asyncio.Future = None
+    _is_traced    : bool = False
+
+    def __post_init__(self):
+        if self.start is None:
+            self.start = _trace.now()
+        log_dir = Path(self.log_dir) if self.log_dir else _log_utils.get_log_dir()
+        if self.stdout_log is None:
+            self.stdout_log = BuildLog(_log_utils.new_log_path(log_dir, f'{self.pkg_name}-{self.type_}.stdout'))
+        if self.stderr_log is None:
+            self.stderr_log = BuildLog(_log_utils.new_log_path(log_dir, f'{self.pkg_name}-{self.type_}.stderr'))
+        # stderr must be drained while we wait for stdout, otherwise the build
+        # process might block on a full pipe
+        if self._stderr_reader is None:
+            self._stderr_reader = asyncio.ensure_future(_copy_stream(self.proc.stderr, self.stderr_log))
+
+    def __await__(self):
+        return self.wait().__await__()
 
-    def is_build_done(self, consume_output=True):
-        return self.is_process_done(consume_output=consume_output)
+    @property
+    def stdout(self):
+        return self.stdout_log.tail()
+
+    @property
+    def stderr(self):
+        return self.stderr_log.tail()
+
+    async def wait(self):
+        await _copy_stream(self.proc.stdout, self.stdout_log)
+        await self._stderr_reader
+        await self.proc.wait()
+        if not self._is_traced:
+            output_bytes = self.stdout_log.size + self.stderr_log.size
+            _trace.record_command(self.cmd, start=self.start, package=self.pkg_name, returncode=self.rc, output_bytes=output_bytes)
+            self._is_traced = True
+        return self
+
+    def _is_watching_task(self):
+        return self.detached and (self.rc == 0) and (self.task_id is not None)
+
+    def is_build_done(self):
+        if self.rc is None:
+            return False
+        if self._is_watching_task():
+            return (self.task_state in TASK_FINAL_STATES)
+        return True
 
     def did_fail(self):
         return (self.is_build_done() and not self.was_successful())
@@ -70,142 +209,408 @@ class BuildProcess:
     def was_successful(self):
         if not self.is_build_done():
             return None
+        if self._is_watching_task():
+            return (self.task_state == TASK_STATE_CLOSED)
         # TODO: Check output
         return (self.rc == 0)
 
-    def is_process_done(self, consume_output=True):
-        was_running = (self._rc is None)
-        is_running = (self.rc is None)
-        is_done = not is_running
-        if was_running and is_done and consume_output:
-            stdout, stderr = self.proc.communicate()
-            self.stdout += stdout
-            self.stderr += stderr
-        return is_done
-
     @property
     def rc(self):
-        if self._rc is None:
-            self.proc.poll()
-            self._rc = self.proc.returncode
-        return self._rc
+        return self.proc.returncode
+
 
+@dataclass
+class KojiWatch:
+    hub          : KojiHub
+    poll_interval: float
 
-def trigger_koji_build(pkg_path, *, scratch):
+
+async def trigger_koji_build(pkg_path, *, scratch, target=None, detach=False, srpms=None):
     pkg_name = pkg_path.name
     path_src_rpm = None
     if scratch:
         cmd = ['/usr/bin/fedpkg', 'scratch-build']
-        if _git.has_unpushed_changes(pkg_path):
-            path_src_rpm = create_srpm(pkg_path)
+        if await asyncio.to_thread(_git.has_unpushed_changes, pkg_path):
+            path_src_rpm = await srpms.get(pkg_path) if srpms else await create_srpm(pkg_path)
             cmd += ['--srpm', str(path_src_rpm)]
     else:
         cmd = ['/usr/bin/fedpkg', 'build']
-    fedpkg_proc = run_cmd(cmd, working_directory=pkg_path)
-    build = BuildProcess(pkg_name=pkg_name, proc=fedpkg_proc, type_='koji')
+    if target:
+        cmd += ['--target', target]
+    if detach:
+        cmd += ['--nowait']
+    fedpkg_proc = await start_cmd_async(cmd, working_directory=pkg_path)
+    build = BuildProcess(pkg_name=pkg_name, proc=fedpkg_proc, type_='koji', cmd=tuple(cmd), detached=detach)
     task_info_regex = re.compile(b'Task info: (https://.+?\=(\d+))\n')
-    _extract_urls_from_build_output(build, task_info_regex)
+    await _extract_urls_from_build_output(build, task_info_regex, build_info_regex=_building_regex)
     if path_src_rpm:
         path_src_rpm.unlink()
     return build
 
 
-def _extract_urls_from_build_output(build, regex, *, multiline_regex=False):
+async def _copy_stream(stream, build_log):
+    while True:
+        data = await stream.read(_READ_SIZE)
+        if not data:
+            break
+        build_log.write(data)
+    build_log.close()
+
+
+async def _extract_urls_from_build_output(build, regex, *, multiline_regex=False, build_info_regex=None):
+    line_window = LineWindow() if multiline_regex else None
     while True:
-        build_output = build.proc.stdout.readline()
-        if build_output:
-            build.stdout += build_output
-            match = regex.search(build.stdout if multiline_regex else build_output)
-            if match:
-                build.url = match.group(1).decode('utf8')
-                build.task_id = match.group(2).decode('utf8')
-                break
-        elif build.is_process_done():
+        build_output = await build.proc.stdout.readline()
+        if not build_output:
+            # process closed stdout (usually because it exited)
+            break
+        build.stdout_log.write(build_output)
+        info_match = build_info_regex.search(build_output) if build_info_regex else None
+        if info_match:
+            build.nvr = info_match.group(1).decode('utf8')
+            build.target = info_match.group(2).decode('utf8')
+            continue
+        if multiline_regex:
+            match = line_window.search(regex, build_output)
+        else:
+            match = regex.search(build_output)
+        if match:
+            build.url = match.group(1).decode('utf8')
+            build.task_id = match.group(2).decode('utf8')
             break
 
-def trigger_copr_build(pkg_path, copr_repo):
+async def trigger_copr_build(pkg_path, copr_repo, *, after_build_id=None, with_build_id=None, srpms=None):
     pkg_name = pkg_path.name
-    path_src_rpm = create_srpm(pkg_path)
+    path_src_rpm = await srpms.get(pkg_path) if srpms else await create_srpm(pkg_path)
     cmd = ['/usr/bin/copr-cli', 'build', copr_repo, str(path_src_rpm)]
-    copr_proc = run_cmd(cmd, working_directory=pkg_path)
-    build = BuildProcess(pkg_name=pkg_name, proc=copr_proc, type_='copr')
+    # copr batches: builds in one batch run concurrently, a batch starts
+    # after the batch containing the "after" build finished
+    if after_build_id:
+        cmd += ['--after-build-id', after_build_id]
+    elif with_build_id:
+        cmd += ['--with-build-id', with_build_id]
+    copr_proc = await start_cmd_async(cmd, working_directory=pkg_path)
+    build = BuildProcess(pkg_name=pkg_name, proc=copr_proc, type_='copr', cmd=tuple(cmd))
 
     pattern = (
         b'Build was added to ' + copr_repo.encode('ascii') + b':' + \
         b'\s*(https://.+?/build/(\d+))\s*\n'
     )
     build_url_regex = re.compile(pattern)
-    _extract_urls_from_build_output(build, build_url_regex, multiline_regex=True)
+    await _extract_urls_from_build_output(build, build_url_regex, multiline_regex=True)
     path_src_rpm.unlink()
     return build
 
 
-def trigger_mock_build(pkg_path, *, wait=False):
+def _mock_root_for_branch(branch_name):
+    arch = platform.machine()
+    if branch_name in ('master', 'main', 'rawhide'):
+        return f'fedora-rawhide-{arch}'
+    match = re.match('^(f|epel)(\d+)$', branch_name)
+    if not match:
+        return None
+    distro = 'fedora' if (match.group(1) == 'f') else 'epel'
+    return f'{distro}-{match.group(2)}-{arch}'
+
+
+async def trigger_mock_build(pkg_path, *, wait=False, srpms=None, mock_root=None, cpus=None):
     pkg_name = pkg_path.name
 
-    cmd = ['/usr/bin/fedpkg', 'mockbuild']
-    mock_proc = run_cmd(cmd, working_directory=pkg_path)
-    build = BuildProcess(pkg_name=pkg_name, proc=mock_proc, type_='mock')
+    if srpms is None:
+        cmd = ['/usr/bin/fedpkg', 'mockbuild']
+    else:
+        # concurrent builds: separate buildroot per package (--uniqueext)
+        path_src_rpm = await srpms.get(pkg_path)
+        cmd = [
+            '/usr/bin/mock', '--root', mock_root, f'--uniqueext={pkg_name}',
+            '--resultdir', str(pkg_path.resolve() / f'results_{pkg_name}'),
+        ]
+        if cpus:
+            cmd += ['--define', f'_smp_ncpus_max {cpus}']
+        cmd += ['--rebuild', str(path_src_rpm)]
+    mock_proc = await start_cmd_async(cmd, working_directory=pkg_path)
+    build = BuildProcess(pkg_name=pkg_name, proc=mock_proc, type_='mock', cmd=tuple(cmd))
     if wait:
-        build.proc.wait()
+        await build
     return build
 
-def _handle_build_completion(build, builds_in_progress):
+def _handle_build_completion(build):
     if not build.is_build_done():
         return
-    builds_in_progress.remove(build)
 
     # LATER: new package version would be nice
     print_status_output(build.pkg_name, is_error=(not build.was_successful()))
     if build.did_fail():
         display_output(build.stdout, build.stderr, header_str=build.pkg_name)
+        for build_log in (build.stdout_log, build.stderr_log):
+            if build_log.size > build_log.tail_size:
+                print(f'(output truncated, {build_log.describe_files()})')
+
+async def _wait_for_build_completion(builds_in_progress):
+    # as_completed() yields each build as soon as its process exits
+    for next_build in asyncio.as_completed(builds_in_progress):
+        build = await next_build
+        _handle_build_completion(build)
+
+async def _watch_koji_tasks(builds, koji_watch):
+    """Poll the state of all detached koji tasks with one request per interval."""
+    # "fedpkg --nowait" exits right after the submission
+    await _wait_for_build_completion(builds)
+    pending_builds = [build for build in builds if not build.is_build_done()]
+    while pending_builds:
+        await asyncio.sleep(koji_watch.poll_interval)
+        task_ids = [build.task_id for build in pending_builds]
+        try:
+            task_states = await asyncio.to_thread(koji_watch.hub.get_task_states, task_ids)
+        except (KojiError, xmlrpc.client.ProtocolError, OSError) as e:
+            # the builds continue anyway, just try again after the next interval
+            print_status_output('koji', is_warning=True, msg=f'polling tasks failed ({e})')
+            continue
+        for build in pending_builds:
+            build.task_state = task_states[int(build.task_id)]
+            _handle_build_completion(build)
+        pending_builds = [build for build in pending_builds if not build.is_build_done()]
+
+async def _wait_for_koji_builds(builds, koji_watch):
+    if koji_watch:
+        await _watch_koji_tasks(builds, koji_watch)
+    else:
+        await _wait_for_build_completion(builds)
+
+
+def _prepare_package(pkg_name, branch_name):
+    pkg_path = Path(pkg_name)
+    if _git.has_uncommitted_changes(pkg_path):
+        error_msg = 'uncommitted changes, skipping package'
+        print_status_output(pkg_name, is_error=True, msg=error_msg)
+        return None
+    _git.switch_to_branch(branch_name, pkg_path)
+    return pkg_path
+
+
+def _available_memory_mb():
+    try:
+        with open('/proc/meminfo', 'r') as fp:
+            for line in fp:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) // 1024
+    except OSError:
+        pass
+    return None
+
+
+def _mock_jobs(jobs, *, cpus, memory_estimate_mb):
+    """Reduce the number of concurrent builds so each gets its CPU budget and
+    the estimated memory of all builds fits into the available memory.
+
+    mock does not limit the memory of a build so this is only a heuristic."""
+    mock_jobs = min(jobs, max(1, (os.cpu_count() or 1) // cpus))
+    available_memory = _available_memory_mb()
+    if available_memory:
+        mock_jobs = min(mock_jobs, max(1, available_memory // memory_estimate_mb))
+    return mock_jobs
+
+
+def _print_mock_summary(results, wall_time):
+    print('\nmock builds:')
+    for build, duration in sorted(results, key=lambda result: result[0].pkg_name):
+        status_str = 'ok' if build.was_successful() else 'FAILED'
+        print(f'  {build.pkg_name:<40} {status_str:<7} {duration:7.0f}s')
+    failed = sum(1 for build, _ in results if not build.was_successful())
+    total_duration = sum(duration for _, duration in results)
+    print(f'{len(results) - failed} succeeded, {failed} failed, {wall_time:.0f}s ({total_duration:.0f}s build time)')
+
+
+async def run_mock_builds(pkg_paths, *, jobs, cpus, memory_estimate_mb, mock_root):
+    mock_jobs = _mock_jobs(jobs, cpus=cpus, memory_estimate_mb=memory_estimate_mb)
+    if mock_jobs < jobs:
+        print(f'running {mock_jobs} mock builds at a time ({cpus} cores each, assuming up to {memory_estimate_mb} MB each)')
+    # longest builds first so no long build starts last (unknown packages
+    # are assumed to be slow)
+    ordered_paths = sorted(pkg_paths, key=lambda pkg_path: -_mock_durations.get(pkg_path.name, float('inf')))
+    build_slots = asyncio.Semaphore(mock_jobs)
+    start = time.monotonic()
+
+    async def build_package(pkg_path):
+        await srpms.get(pkg_path)
+        async with build_slots:
+            build_start = time.monotonic()
+            build = await trigger_mock_build(pkg_path, wait=True, srpms=srpms, mock_root=mock_root, cpus=cpus)
+            duration = time.monotonic() - build_start
+        if build.was_successful():
+            _mock_durations.set(pkg_path.name, duration)
+        _handle_build_completion(build)
+        return (build, duration)
+
+    async with SrpmBuilder() as srpms:
+        srpms.prefetch(ordered_paths)
+        results = await asyncio.gather(*(build_package(pkg_path) for pkg_path in ordered_paths))
+    _print_mock_summary(results, time.monotonic() - start)
+
+
+def _print_build_urls(builds):
+    for build in builds:
+        if build.url:
+            print(f'{build.pkg_name}: {build.url}')
+
+
+def _skip_failed_dependencies(layer, dependencies, failed_pkgs):
+    buildable = []
+    for pkg_path in layer:
+        failed_dependencies = dependencies[pkg_path.name].intersection(failed_pkgs)
+        if failed_dependencies:
+            error_msg = 'skipped, build of ' + ', '.join(sorted(failed_dependencies)) + ' failed'
+            print_status_output(pkg_path.name, is_error=True, msg=error_msg)
+            failed_pkgs.add(pkg_path.name)
+        else:
+            buildable.append(pkg_path)
+    return buildable
+
+
+async def _wait_for_repo(builds):
+    """Wait until koji regenerated the buildroot repo with the given builds."""
+    builds_by_target = {}
+    for build in builds:
+        if build.target and build.nvr:
+            builds_by_target.setdefault(build.target, []).append(build.nvr)
+    for target, nvrs in builds_by_target.items():
+        cmd = ['/usr/bin/koji', 'wait-repo', '--target', target, *(f'--build={nvr}' for nvr in nvrs)]
+        result = await run_cmd_async(cmd, exit_on_error=False)
+        if result.returncode:
+            print_status_output(target, is_warning=True, msg='koji wait-repo failed')
+
+
+def _is_built(pkg_path, branch_name):
+    state = _state.get_state_store().get(pkg_path.name, branch_name)
+    return (state.built_sha is not None) and (state.built_sha == _git.head_sha(pkg_path))
+
+def _record_successful_builds(builds, pkg_paths_by_name, branch_name):
+    state_store = _state.get_state_store()
+    for build in builds:
+        head_sha = _git.head_sha(pkg_paths_by_name[build.pkg_name])
+        state_store.update(build.pkg_name, branch_name, built_sha=head_sha, build_nvr=build.nvr)
+
+
+async def _run_koji_layers(layers, dependencies, *, target, koji_watch, branch_name):
+    failed_pkgs = set()
+    detach = (koji_watch is not None)
+    for layer_idx, layer in enumerate(layers):
+        layer = _skip_failed_dependencies(layer, dependencies, failed_pkgs)
+        builds = await asyncio.gather(*(trigger_koji_build(pkg_path, scratch=False, target=target, detach=detach) for pkg_path in layer))
+        _print_build_urls(builds)
+        await _wait_for_koji_builds(builds, koji_watch)
+        failed_pkgs.update(build.pkg_name for build in builds if not build.was_successful())
+        successful_builds = [build for build in builds if build.was_successful()]
+        _record_successful_builds(successful_builds, {pkg_path.name: pkg_path for pkg_path in layer}, branch_name)
+        is_last_layer = (layer_idx == len(layers) - 1)
+        if successful_builds and not is_last_layer:
+            # the next layer must see these builds in its buildroot
+            await _wait_for_repo(successful_builds)
+
+
+async def _submit_copr_layers(layers, dependencies, copr_repo, srpms):
+    srpms.prefetch(pkg_path for layer in layers for pkg_path in layer)
+    builds = []
+    failed_pkgs = set()
+    previous_batch_id = None
+    for layer in layers:
+        layer = _skip_failed_dependencies(layer, dependencies, failed_pkgs)
+        # the first build which copr accepted starts the batch of this layer,
+        # without a batch id the other builds would neither be batched nor
+        # wait for the previous layer
+        batch_id = None
+        while layer and (batch_id is None):
+            first_build = await trigger_copr_build(layer.pop(0), copr_repo, after_build_id=previous_batch_id, srpms=srpms)
+            builds.append(first_build)
+            batch_id = first_build.task_id
+            if batch_id is None:
+                print_status_output(first_build.pkg_name, is_error=True, msg='copr submission failed (no build id)')
+                failed_pkgs.add(first_build.pkg_name)
+        other_builds = await asyncio.gather(*(
+            trigger_copr_build(pkg_path, copr_repo, with_build_id=batch_id, srpms=srpms) for pkg_path in layer
+        ))
+        builds += other_builds
+        failed_pkgs.update(build.pkg_name for build in other_builds if build.task_id is None)
+        if batch_id is not None:
+            previous_batch_id = batch_id
+    return builds
+
+
+async def run_builds(pkg_paths, arguments, *, dependencies):
+    copr_repo = arguments['--copr']
+    pkg_paths_by_name = {pkg_path.name: pkg_path for pkg_path in pkg_paths}
+    layers = [[pkg_paths_by_name[pkg_name] for pkg_name in layer] for layer in build_layers(dependencies)]
+    if arguments['--mock']:
+        jobs = int(arguments['--jobs'])
+        if jobs == 1:
+            for pkg_path in (pkg_path for layer in layers for pkg_path in layer):
+                build = await trigger_mock_build(pkg_path, wait=True)
+                _handle_build_completion(build)
+            return
+        # local builds do not see each other's results so the build order
+        # does not matter
+        mock_root = arguments['--mock-root'] or _mock_root_for_branch(arguments['--branch'] or 'master')
+        if mock_root is None:
+            print_status_output('mock', is_error=True, msg='unknown mock config for branch, please use --mock-root')
+            sys.exit(1)
+        cpus = int(arguments['--mock-cpus'] or max(1, (os.cpu_count() or 1) // jobs))
+        await run_mock_builds(pkg_paths, jobs=jobs, cpus=cpus, memory_estimate_mb=int(arguments['--mock-memory-estimate']), mock_root=mock_root)
+        return
 
-def _wait_for_build_completion(builds_in_progress):
-    while builds_in_progress:
-        for build in tuple(builds_in_progress):
-            _handle_build_completion(build, builds_in_progress)
-        time.sleep(1)
+    koji_watch = None
+    if arguments['--detach']:
+        koji_hub = KojiHub(arguments['--koji-hub'])
+        koji_watch = KojiWatch(hub=koji_hub, poll_interval=float(arguments['--poll-interval']))
+    if arguments['--build']:
+        # TODO: check also that sources file is updated!
+        branch_name = arguments['--branch'] or 'master'
+        await _run_koji_layers(layers, dependencies, target=arguments['--side-tag'], koji_watch=koji_watch, branch_name=branch_name)
+        return
+    # SRPMs are only needed until the submission finished
+    async with SrpmBuilder() as srpms:
+        if arguments['--scratch']:
+            # scratch builds never end up in a buildroot so there is nothing to wait for
+            detach = (koji_watch is not None)
+            builds = await asyncio.gather(*(
+                trigger_koji_build(pkg_path, scratch=True, detach=detach, srpms=srpms) for pkg_path in pkg_paths
+            ))
+        else:
+            builds = await _submit_copr_layers(layers, dependencies, copr_repo, srpms)
+    _print_build_urls(builds)
+    if arguments['--scratch']:
+        await _wait_for_koji_builds(builds, koji_watch)
+    else:
+        await _wait_for_build_completion(builds)
 
 
 def main():
     arguments = docopt(__doc__)
     branch_name = arguments['--branch'] or 'master'
-    copr_repo = arguments['--copr']
+    if arguments['--trace']:
+        _trace.enable_tracing(arguments['--trace'])
 
-    is_koji_build = (arguments['--scratch'] or arguments['--build'])
     pkg_names = sanitize_pkg_names(arguments['<pkg>'])
+    declared_dependencies = {}
     if not pkg_names:
         pkg_names = parse_package_list('CERTBOT-PLUGINS.txt')
-    builds_in_progress = []
+        declared_dependencies = parse_package_dependencies('CERTBOT-PLUGINS.txt')
+    pkg_paths = []
     for pkg_name in pkg_names:
-        pkg_path = Path(pkg_name)
-        if _git.has_uncommitted_changes(pkg_path):
-            error_msg = 'uncommitted changes, skipping package'
-            print_status_output(pkg_name, is_error=True, msg=error_msg)
+        pkg_path = _prepare_package(pkg_name, branch_name)
+        if pkg_path is None:
             continue
-        _git.switch_to_branch(branch_name, pkg_path)
-
-        if is_koji_build:
-            if arguments['--scratch']:
-                build = trigger_koji_build(pkg_path, scratch=True)
-            elif arguments['--build']:
-                # TODO: check also that sources file is updated!
-                build = trigger_koji_build(pkg_path, scratch=False)
-        elif arguments['--mock']:
-            build = trigger_mock_build(pkg_path, wait=True)
-            _handle_build_completion(build, [build])
-            build = None
-        elif arguments['--copr']:
-            build = trigger_copr_build(pkg_path, copr_repo)
-        if build is not None:
-            builds_in_progress.append(build)
-
-    for build in builds_in_progress:
-        if build.url:
-            print(f'{build.pkg_name}: {build.url}')
-    _wait_for_build_completion(builds_in_progress)
+        if arguments['--only-changed'] and arguments['--build'] and _is_built(pkg_path, branch_name):
+            print_status_output(pkg_name, msg='already built from HEAD')
+            continue
+        pkg_paths.append(pkg_path)
+
+    dependencies = read_build_dependencies(pkg_paths, declared=declared_dependencies)
+    try:
+        asyncio.run(run_builds(pkg_paths, arguments, dependencies=dependencies))
+    except DependencyCycle as e:
+        print_status_output('build order', is_error=True, msg=str(e))
+        sys.exit(1)
 
 
 if __name__ == '__main__':
     main()
-
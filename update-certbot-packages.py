@@ -8,8 +8,19 @@ Usage:
 
 Options:
   --verbose-dry-run        query bugzilla only
+  --refresh                ignore cached bugzilla results
+  --bugzilla-ttl=<MIN>     reuse cached bugzilla results for <MIN> minutes [default: 60]
+  --jobs=<N>               concurrent git pulls, downloads and uploads [default: 8]
+  --prep-jobs=<N>          concurrent signature checks [default: 2]
+  --full-prep              verify signatures by running "fedpkg prep"
+  --only-changed           skip packages whose current bugzilla issue was already handled
+  --prefetch               "git fetch" all packages in the background while bugzilla is queried
+  --prefetch-jobs=<N>      concurrent background fetches [default: 4]
+  --trace=<FILE>           write a Chrome trace of all commands and print a timing summary
 """
 
+from dataclasses import dataclass
+import functools
 import importlib
 from pathlib import Path
 import re
@@ -23,11 +34,15 @@ except ImportError:
     sys.stderr.write('please install python3-docopt\n')
     sys.exit(1)
 
+_bump = importlib.import_module('bump-rpm-version')
 _bz = importlib.import_module('bugzilla-utils')
 _colorama_utils = importlib.import_module('colorama-utils')
 _git = importlib.import_module('git-utils')
+_parallel = importlib.import_module('parallel-utils')
 _pkg_list = importlib.import_module('pkg-list')
 _shell_utils = importlib.import_module('shell-utils')
+_state = importlib.import_module('state-utils')
+_trace = importlib.import_module('trace-utils')
 _fed_utils = importlib.import_module('fedora-utils')
 
 colorama_color = _colorama_utils.colorama_color
@@ -36,56 +51,144 @@ print_status_output = _shell_utils.print_status_output
 print_in_progress = _shell_utils.print_in_progress
 parse_package_list = _pkg_list.parse_package_list
 run_cmd = _shell_utils.run_cmd
+BumpError = _bump.BumpError
+PackageResult = _parallel.PackageResult
+Stage = _parallel.Stage
 
 THIS_DIR = Path(__file__).parent.resolve()
 
 
-def main():
-    arguments = docopt(__doc__)
-    package_set = _shell_utils.sanitize_pkg_names(arguments['<pkg>'])
+@dataclass
+class PackageUpdate:
+    pkg_name   : str
+    pkg_path   : Path
+    bug_summary: str
+    bug_id     : str
+    new_version: str   = None
+    old_version: str   = None
+    message    : str   = None
+    new_sources: tuple = ()
+
+
+def _handle_bump_errors(stage_handler):
+    def handler(update):
+        try:
+            return stage_handler(update)
+        except BumpError as e:
+            return PackageResult(update.pkg_name, is_error=True, msg=str(e))
+    return handler
+
+def _update_checkout(update, *, prefetch=None):
+    if _git.has_uncommitted_changes(update.pkg_path):
+        error_msg = 'uncommitted changes, skipping package'
+        return PackageResult(update.pkg_name, is_error=True, msg=error_msg)
+    _git.switch_to_branch('rawhide', update.pkg_path)
+    if (prefetch is not None) and prefetch.wait(update.pkg_path):
+        # already fetched, no network access needed
+        _git.merge('origin/rawhide', update.pkg_path, ff_only=True)
+    else:
+        _git.pull('origin', update.pkg_path, ff_only=True)
+
+def _bump_spec(update):
+    update.new_version = _bump.version_from_bug_summary(update.pkg_name, update.bug_summary)
+    bump_info = _bump.bump_version(update.pkg_path, update.pkg_name, update.new_version, update.bug_id)
+    if bump_info is None:
+        _state.get_state_store().update(update.pkg_name, 'rawhide', bug_id=update.bug_id)
+        return PackageResult(update.pkg_name, msg=f'Already up to date ({update.new_version})')
+    update.old_version, update.message = bump_info
+
+def _download_sources(update):
+    update.new_sources = _bump._download_new_sources(update.pkg_path, update.pkg_name)
+
+def _verify_signature(update, *, full_prep):
+    _bump.ensure_valid_signature(update.pkg_name, update.pkg_path, full_prep=full_prep)
+
+def _upload_and_commit(update):
+    _bump.upload_new_sources(update.pkg_path, update.new_sources)
+    _git.commit(update.pkg_path, update.message)
+    _state.get_state_store().update(update.pkg_name, 'rawhide', bug_id=update.bug_id)
+    return PackageResult(update.pkg_name, msg=f'{update.old_version} -> {update.new_version}')
+
+
+def build_update_stages(*, jobs, prep_jobs, full_prep=False, prefetch=None):
+    update_checkout = functools.partial(_update_checkout, prefetch=prefetch)
+    verify_signature = functools.partial(_verify_signature, full_prep=full_prep)
+    stages = (
+        ('pull',     update_checkout,    jobs),
+        ('bump',     _bump_spec,         jobs),
+        ('download', _download_sources,  jobs),
+        ('verify',   verify_signature,   prep_jobs),
+        ('upload',   _upload_and_commit, jobs),
+    )
+    return [Stage(name, _handle_bump_errors(handler), limit) for name, handler, limit in stages]
+
+
+def update_packages(package_set, arguments, *, prefetch=None):
     verbose_dry_run = arguments['--verbose-dry-run']
+    refresh = arguments['--refresh']
+    bugzilla_ttl = int(arguments['--bugzilla-ttl']) * 60
+    pkg_data = _bz.retrieve_release_notification_bugs(package_set, refresh=refresh, cache_ttl=bugzilla_ttl)
 
-    if not package_set:
-        package_set = parse_package_list('CERTBOT-ALL-PACKAGES-AND-PLUGINS.txt')
-
-    if not _fed_utils.has_kerberos_ticket():
-        print_status_output('no valid kerberos ticket', is_warning=True)
-        return
-
-    pkg_data = _bz.retrieve_release_notification_bugs(package_set)
-
+    only_changed = arguments['--only-changed']
+    state_store = _state.get_state_store()
+    updates = []
     for pkg_name in package_set:
         if pkg_name not in pkg_data:
             print_status_output(pkg_name, is_warning=True, msg='no bugzilla issue')
             continue
         (bug_summary, bug_id) = pkg_data[pkg_name]
-        progress_msg = f'#{bug_id} -- {bug_summary}' if verbose_dry_run else ''
-        print_in_progress(pkg_name, msg=progress_msg)
+        if only_changed and (state_store.get(pkg_name, 'rawhide').bug_id == bug_id):
+            print_status_output(pkg_name, msg=f'#{bug_id} already handled')
+            continue
         assert 'is available' in bug_summary
         pkg_path = (THIS_DIR / '..' / pkg_name).resolve()
 
-        if _git.has_uncommitted_changes(pkg_path):
-            error_msg = 'uncommitted changes, skipping package'
-            print_status_output(pkg_name, is_error=True, msg=error_msg)
-            continue
-        elif verbose_dry_run:
-            # ensure next package name is printed on a new line
-            # "print_in_progress()" prints without newline
-            print('\n', end='')
-            continue
-        _git.switch_to_branch('rawhide', pkg_path)
-        _git.pull('origin', pkg_path, ff_only=True)
-
-        bump_version = str(THIS_DIR / 'bump-rpm-version.py')
-        bump_cmd = [bump_version, pkg_name, bug_summary, bug_id]
-        bump_proc = run_cmd(bump_cmd, working_directory=pkg_path, wait=True, exit_on_error=False)
-        if bump_proc.returncode != 0:
-            error = 'error while bumping version in spec file'
-            print_status_output(pkg_name, is_error=True, msg=error)
+        if verbose_dry_run:
+            print_in_progress(pkg_name, msg=f'#{bug_id} -- {bug_summary}')
+            if _git.has_uncommitted_changes(pkg_path):
+                error_msg = 'uncommitted changes, skipping package'
+                print_status_output(pkg_name, is_error=True, msg=error_msg)
+            else:
+                # ensure next package name is printed on a new line
+                # "print_in_progress()" prints without newline
+                print('\n', end='')
             continue
-        bump_str = bump_proc.stdout.read().decode('utf8').strip()
+        updates.append(PackageUpdate(pkg_name, pkg_path, bug_summary, bug_id))
+    if prefetch is not None:
+        # packages without (new) bugzilla issue are not pulled
+        prefetch.restrict_to(update.pkg_path for update in updates)
+
+    jobs = _parallel.parse_jobs(arguments['--jobs'])
+    prep_jobs = _parallel.parse_jobs(arguments['--prep-jobs'])
+    full_prep = arguments['--full-prep']
+    stages = build_update_stages(jobs=jobs, prep_jobs=prep_jobs, full_prep=full_prep, prefetch=prefetch)
+    _parallel.run_pipeline(stages, updates)
+
+
+def main():
+    arguments = docopt(__doc__)
+    package_set = _shell_utils.sanitize_pkg_names(arguments['<pkg>'])
+    if arguments['--trace']:
+        _trace.enable_tracing(arguments['--trace'])
+
+    if not package_set:
+        package_set = parse_package_list('CERTBOT-ALL-PACKAGES-AND-PLUGINS.txt')
+
+    if not _fed_utils.has_kerberos_ticket():
+        print_status_output('no valid kerberos ticket', is_warning=True)
+        return
 
-        print_status_output(pkg_name, msg=bump_str, is_error=False)
+    # the fetches overlap the bugzilla query and the work on earlier packages
+    prefetch = None
+    if arguments['--prefetch'] and not arguments['--verbose-dry-run']:
+        pkg_paths = [(THIS_DIR / '..' / pkg_name).resolve() for pkg_name in package_set]
+        prefetch_jobs = _parallel.parse_jobs(arguments['--prefetch-jobs'])
+        prefetch = _git.Prefetch(pkg_paths, max_jobs=prefetch_jobs)
+    try:
+        update_packages(package_set, arguments, prefetch=prefetch)
+    finally:
+        if prefetch is not None:
+            prefetch.close()
 
 if __name__ == '__main__':
     main()